@@ -1,24 +1,857 @@
 
 #Importing the relevant modules
 import sqlite3
-import matplotlib.pyplot as plt
-import pandas as pd
 import argparse
+import collections
+import contextlib
+import cProfile
+import csv
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+#resource is only available on Unix, where it is used for the peak memory of a profile
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#Number of rows written per executemany call during loading
+DEFAULT_BATCH_SIZE = 1000
+
+#Number of subjects whose feature summaries are buffered in memory while loading, before they are merged into FeatureSummary
+SUMMARY_BUFFER_SUBJECTS = 8
+
+#Number of compiled statements kept by the query connection
+STATEMENT_CACHE_SIZE = 256
+
+#Page size of snapshots written by --snapshot; larger pages keep more of a wide abundance row on one page
+SNAPSHOT_PAGE_SIZE = 16384
+
+#Memory-mapped size and page cache size, in MiB, of the read-only connections of --read-only
+READ_ONLY_MMAP_MB = 1024
+READ_ONLY_CACHE_MB = 64
+
+#Secondary and covering indexes for the access paths of the query catalogue, as (index name, table, columns)
+#They are built after loading, so the load does not have to maintain them row by row
+INDEXES = [
+    #query 1 (Age > 70), query 6 (min/max/avg age) and query 9 (age and bmi not null)
+    ('idx_subject_age_bmi', 'Subject', 'Age, BMI, SubjectID'),
+    #query 2 (female subjects with a healthy bmi, ordered by bmi)
+    ('idx_subject_sex_bmi', 'Subject', 'Sex, BMI, SubjectID'),
+    #query 4 (insulin-resistant subjects joined to their samples)
+    ('idx_subject_insulin', 'Subject', 'InsulinSensitivity, SubjectID'),
+    #query 5 (KEGG IDs of a list of peaks)
+    ('idx_peakannotation_peak_kegg', 'PeakAnnotation', 'PeakID, KEGG'),
+    #query 7 and class_counts (pathways and chemical classes by annotation count)
+    ('idx_pathwaycount_count', 'PathwayCount', 'AnnotationCount, PathwayID'),
+    ('idx_classcount_count', 'ClassCount', 'AnnotationCount, ClassID'),
+    #query 4 and the omics coverage queries (subjects with samples of one omics layer)
+    ('idx_sampleindex_transcript', 'SampleIndex', 'has_transcript, SubjectID'),
+    ('idx_sampleindex_protein', 'SampleIndex', 'has_protein, SubjectID'),
+    ('idx_sampleindex_metabolite', 'SampleIndex', 'has_metabolite, SubjectID'),
+]
+
+#Abundance tables that can be named as a query parameter
+ABUNDANCE_TABLES = ['TranscriptSamples', 'ProteinSamples', 'MetaboliteSamples']
+
+#Column of the SampleIndex table flagging the samples of each abundance table
+SAMPLE_INDEX_COLUMNS = {
+    'TranscriptSamples': 'has_transcript',
+    'ProteinSamples': 'has_protein',
+    'MetaboliteSamples': 'has_metabolite',
+}
+
+#Catalogue of named, parameterized queries
+#Every query has typed parameters with defaults, which are passed to SQLite as bound parameters.
+#'table' and 'feature' are identifiers in the wide layout; they are checked against the schema before being put into the SQL.
+#'layer' is the SampleIndex column of the 'table' parameter.
+#The values of the 'batch' parameters are loaded into the temp.QueryBatch table, one row per parameter and value, so many subjects,
+#features or peaks are looked up in one query; 'batch_sql' is used instead of 'sql' when more than one value is given and returns
+#the batch values as the first columns.
+#Queries with a 'number' are the queries 1-9 of --querydb.
+QUERY_CATALOGUE = {
+    # Retrieving the SubjectID and Age of subjects whose age is greater than 70
+    'older_than': {
+        'number': 1,
+        'params': {'age': (float, 70)},
+        'sql': '''
+            SELECT SubjectID, Age
+            FROM Subject
+            WHERE Age > :age
+        ''',
+    },
+
+    # Retrieving all female SubjectID who have a healthy BMI (18.5 to 24.9) and sorting the results by bmi in descending order
+    'bmi_range': {
+        'number': 2,
+        'params': {'sex': (str, 'F'), 'bmi_min': (float, 18.5), 'bmi_max': (float, 24.9)},
+        'sql': '''
+            SELECT SubjectID
+            FROM Subject
+            WHERE Sex = :sex AND BMI BETWEEN :bmi_min and :bmi_max
+            ORDER BY BMI DESC
+        ''',
+    },
+
+    # Retrieving the Visit IDs of Subject 'ZNQOVZV'
+    # SampleIndex lists every (SubjectID, VisitID) with samples in any abundance table, so the visits of a subject
+    # are read from its primary key instead of a union over the three abundance tables
+    'subject_visits': {
+        'number': 3,
+        'params': {'subject': (str, 'ZNQOVZV')},
+        'batch': ('subject',),
+        'sql': '''
+            SELECT VisitID
+            FROM SampleIndex
+            WHERE SubjectID = :subject
+        ''',
+        'batch_sql': '''
+            SELECT SubjectID, VisitID
+            FROM SampleIndex
+            WHERE SubjectID IN (SELECT Value FROM temp.QueryBatch WHERE Param = 'subject')
+            ORDER BY SubjectID, VisitID
+        ''',
+    },
+
+    # Retrieving the distinct SubjectIDs who have metabolomics samples and are insulin-resistant
+    # The subjects with samples of the table are read from the SampleIndex flag of that table
+    'omics_insulin_subjects': {
+        'number': 4,
+        'params': {'table': (str, 'MetaboliteSamples'), 'insulin': (str, 'IR')},
+        'sql': '''
+            SELECT DISTINCT SampleIndex.SubjectID
+            FROM SampleIndex,
+                Subject
+            WHERE InsulinSensitivity = :insulin
+            AND SampleIndex.{layer} = 1
+            AND SampleIndex.SubjectID = Subject.SubjectID
+        ''',
+    },
+
+    # Retrieving the number of visits of every subject and how many of them have samples of each omics layer
+    'omics_coverage': {
+        'params': {},
+        'sql': '''
+            SELECT SubjectID,
+                COUNT(*) AS visits,
+                SUM(has_transcript) AS transcript_visits,
+                SUM(has_protein) AS protein_visits,
+                SUM(has_metabolite) AS metabolite_visits
+            FROM SampleIndex
+            GROUP BY SubjectID
+        ''',
+    },
+
+    # Retrieving the subjects with samples of all three omics layers
+    # With same_visit set to 1, only subjects with a visit that has all three layers are returned
+    'complete_subjects': {
+        'params': {'same_visit': (int, 0)},
+        'sql': '''
+            SELECT SubjectID
+            FROM SampleIndex
+            GROUP BY SubjectID
+            HAVING CASE WHEN :same_visit
+                THEN MAX(has_transcript + has_protein + has_metabolite) = 3
+                ELSE MAX(has_transcript) + MAX(has_protein) + MAX(has_metabolite) = 3
+            END
+        ''',
+    },
+
+    # Retrieving the unique KEGG IDs that have been annotated for the following peaks:
+    # 'nHILIC_121.0505_3.5', 'nHILIC_130.0872_6.3', 'nHILIC_133.0506_2.3', 'nHILIC_133.0506_4.4 '
+    'peak_kegg': {
+        'number': 5,
+        'params': {'peak': (str, ['nHILIC_121.0505_3.5', 'nHILIC_130.0872_6.3', 'nHILIC_133.0506_2.3', 'nHILIC_133.0506_4.4'])},
+        'batch': ('peak',),
+        'sql': '''
+            SELECT DISTINCT KEGG
+            FROM PeakAnnotation
+            WHERE PeakID IN (SELECT Value FROM temp.QueryBatch WHERE Param = 'peak')
+        ''',
+    },
+
+    # Retrieving the minimum, maximum and average age of Subjects
+    'age_stats': {
+        'number': 6,
+        'params': {},
+        'sql': '''
+            SELECT MIN(Age) AS min_age,
+                MAX(Age) AS max_age,
+                AVG(Age) AS avg_age
+            FROM Subject
+        ''',
+    },
+
+    # retrieving each pathway and the number of times it has been annotated
+    # only displaying the pathways with counts greater than 10
+    # ordering the results by the count in descending order
+    # The counts are read from the PathwayCount table, which is maintained while the annotations are loaded
+    'pathway_counts': {
+        'number': 7,
+        'params': {'min_count': (int, 10)},
+        'sql': '''
+            SELECT Pathway.Pathway, PathwayCount.AnnotationCount AS count
+            FROM PathwayCount, Pathway
+            WHERE PathwayCount.AnnotationCount > :min_count
+            AND Pathway.PathwayID = PathwayCount.PathwayID
+            ORDER BY count DESC
+        ''',
+    },
+
+    # Retrieving each chemical class and the number of times it has been annotated, from the ClassCount table
+    'class_counts': {
+        'params': {'min_count': (int, 0)},
+        'sql': '''
+            SELECT ChemicalClass.ChemicalClass, ClassCount.AnnotationCount AS count
+            FROM ClassCount, ChemicalClass
+            WHERE ClassCount.AnnotationCount > :min_count
+            AND ChemicalClass.ClassID = ClassCount.ClassID
+            ORDER BY count DESC
+        ''',
+    },
+
+    # Retrieving the maximum abundance of the transcript 'A1BG' for subject 'ZOZOW1T' across all samples
+    # The maximum is read from the FeatureSummary row of the subject and feature, which is computed while loading
+    'max_abundance': {
+        'number': 8,
+        'params': {'table': (str, 'TranscriptSamples'), 'feature': (str, 'A1BG'), 'subject': (str, 'ZOZOW1T')},
+        'batch': ('subject', 'feature'),
+        'sql': '''
+            SELECT (
+                SELECT MaxValue
+                FROM Feature, FeatureSummary
+                WHERE Feature.TableName = :table AND Feature.FeatureName = :feature
+                AND FeatureSummary.SubjectID = :subject AND FeatureSummary.FeatureID = Feature.FeatureID
+            ) AS max_abundance
+        ''',
+        'batch_sql': '''
+            SELECT FeatureSummary.SubjectID, Feature.FeatureName, MaxValue AS max_abundance
+            FROM Feature, FeatureSummary
+            WHERE Feature.TableName = :table
+            AND Feature.FeatureName IN (SELECT Value FROM temp.QueryBatch WHERE Param = 'feature')
+            AND FeatureSummary.SubjectID IN (SELECT Value FROM temp.QueryBatch WHERE Param = 'subject')
+            AND FeatureSummary.FeatureID = Feature.FeatureID
+            ORDER BY FeatureSummary.SubjectID, Feature.FeatureName
+        ''',
+    },
+
+    # Retrieving the number of values, minimum, maximum, mean and variance of one or more features for one or more subjects
+    'feature_summary': {
+        'params': {'table': (str, 'TranscriptSamples'), 'feature': (str, 'A1BG'), 'subject': (str, 'ZOZOW1T')},
+        'batch': ('subject', 'feature'),
+        'sql': '''
+            SELECT FeatureSummary.SubjectID, Feature.FeatureName, ValueCount AS count, MinValue AS min, MaxValue AS max,
+                SumValue / ValueCount AS mean,
+                CASE WHEN ValueCount > 1
+                    THEN (SumSquares - SumValue * SumValue / ValueCount) / (ValueCount - 1)
+                END AS variance
+            FROM Feature, FeatureSummary
+            WHERE Feature.TableName = :table
+            AND Feature.FeatureName IN (SELECT Value FROM temp.QueryBatch WHERE Param = 'feature')
+            AND FeatureSummary.SubjectID IN (SELECT Value FROM temp.QueryBatch WHERE Param = 'subject')
+            AND FeatureSummary.FeatureID = Feature.FeatureID
+            ORDER BY FeatureSummary.SubjectID, Feature.FeatureName
+        ''',
+    },
+
+    # retrieving the age and bmi of of the subjects
+    # omitting the null values
+    'age_bmi': {
+        'number': 9,
+        'params': {},
+        'sql': '''
+            SELECT SubjectID, Age, BMI
+            FROM Subject
+            WHERE Age IS NOT NULL AND BMI IS NOT NULL
+        ''',
+    },
+}
+
+#Names of the queries 1-9 of --querydb
+QUERY_NAMES = {query['number']: name for name, query in QUERY_CATALOGUE.items() if 'number' in query}
+
+#Helper function to parse lines of an abundance file into rows
+#Each row holds the subjectID and visitID taken from the SampleID followed by the abundance values
+#Defined at module level so that it can run in a worker process
+def parse_abundance_lines(lines, sample_index):
+    rows = []
+    for trans_exp in lines:
+        data = trans_exp.rstrip('\r\n').split('\t')
+
+        #Extracting the subjectID and visitID from the sampleID column
+        subject_id, *visit_id = data[sample_index].replace('-', '_').split('_')
+        rows.append([subject_id, '_'.join(visit_id)] + data[1:])
+    return rows
+
+#Values of the abundance files and tables that are missing measurements
+MISSING_VALUES = ('', 'NA', None)
+
+#Helper function to convert rows of abundance values, as parsed or as stored, to a NumPy float matrix
+#Missing and non-numeric values become NaN
+def value_matrix(value_rows):
+    import numpy as np
+    try:
+        return np.array(value_rows, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return np.array([['nan' if value in MISSING_VALUES else value for value in row] for row in value_rows], dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array([[number_or_nan(value) for value in row] for row in value_rows])
+
+#Helper function to convert one value to a float, or NaN if it is not a number
+def number_or_nan(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+#Helper function to summarize the values of the samples of one subject with NumPy
+#Takes the FeatureIDs of the columns and the rows of abundance values of the samples, and returns a list of
+#(FeatureID, count, min, max, sum, sum of squares) for the features with at least one value
+def summarize_samples(feature_keys, value_rows):
+    import numpy as np
+    values = value_matrix(value_rows)
+    present = ~np.isnan(values)
+    counts = present.sum(axis=0)
+    numbers = np.where(present, values, 0.0)
+    minimums = np.where(present, values, np.inf).min(axis=0)
+    maximums = np.where(present, values, -np.inf).max(axis=0)
+    sums = numbers.sum(axis=0)
+    squares = (numbers * numbers).sum(axis=0)
+    columns = np.flatnonzero(counts)
+    return list(zip([feature_keys[i] for i in columns], counts[columns].tolist(), minimums[columns].tolist(),
+                    maximums[columns].tolist(), sums[columns].tolist(), squares[columns].tolist()))
+
+#Helper function to ammend column names by replacing invalid characters
+def new_column_name(column):
+    return column.replace("-", "_").replace(".", "_")
+
+#Helper function to parse the --querydb argument into a list of query numbers
+#Accepts a single query, a range such as 1-9, a list such as 3,5,8 or a combination such as 1-3,8
+def parse_query_list(value):
+    query_nums = []
+    try:
+        for part in value.split(','):
+            first, _, last = part.partition('-')
+            query_nums.extend(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid query list: {value}")
+    if not query_nums or any(query_num not in range(1, 10) for query_num in query_nums):
+        raise argparse.ArgumentTypeError(f"queries must be between 1 and 9: {value}")
+    return query_nums
+
+#Helper function to parse a command line count that must be at least 1, such as --batch-size
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return number
+
+#Helper function to parse the --page-size of a snapshot, which SQLite only accepts as a power of two from 512 to 65536
+#SQLite ignores other page sizes without an error, so they are rejected here
+def snapshot_page_size(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: {value}")
+    if not valid_page_size(number):
+        raise argparse.ArgumentTypeError(f"must be a power of two from 512 to 65536: {value}")
+    return number
+
+#Helper function to check a page size
+def valid_page_size(number):
+    return 512 <= number <= 65536 and number & (number - 1) == 0
+
+#Helper function to expand the values of a repeatable command line parameter
+#Each value may be a comma-separated list, or @FILE to read one value per line from a file
+def expand_values(values):
+    expanded = []
+    for value in values:
+        if value.startswith('@'):
+            with open(value[1:]) as value_file:
+                expanded.extend(line.strip() for line in value_file if line.strip())
+        else:
+            expanded.extend(item for item in value.split(',') if item)
+    return expanded
+
+#Helper functions writing a streamed query result to an open file
+#Each takes the column names, an iterator over the rows and the output file, and returns the number of rows written
+
+#Plain text as printed by --querydb: tab-separated values without a header
+def write_text(columns, rows, out):
+    count = 0
+    for row in rows:
+        out.write('\t'.join(map(str, row)) + '\n')
+        count += 1
+    return count
+
+#Tab-separated values with a header line; NULL values are written as empty fields
+def write_tsv(columns, rows, out):
+    out.write('\t'.join(columns) + '\n')
+    count = 0
+    for row in rows:
+        out.write('\t'.join('' if value is None else str(value) for value in row) + '\n')
+        count += 1
+    return count
+
+#Comma-separated values with a header line, quoted where needed
+def write_csv(columns, rows, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+#JSON Lines: one JSON object per row
+def write_jsonl(columns, rows, out):
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row))) + '\n')
+        count += 1
+    return count
+
+#Apache Arrow IPC stream, a binary columnar format, written one record batch per chunk of rows (requires pyarrow)
+#The schema of a stream cannot change once written, so the column types are fixed by the first chunk: columns with
+#INTEGER or REAL values are float64, because SQLite can store both in one column, and other columns are strings
+#The missing values of the abundance files are null in a numeric column; any other text in it raises ValueError
+def write_arrow(columns, rows, out):
+    import pyarrow as pa
+
+    writer = None
+    count = 0
+    for chunk in batched(rows, DEFAULT_BATCH_SIZE):
+        values = list(zip(*chunk))
+        if writer is None:
+            types = []
+            for column in values:
+                present = [value for value in column if value not in MISSING_VALUES]
+                if present and all(isinstance(value, (int, float)) for value in present):
+                    types.append(pa.float64())
+                else:
+                    types.append(pa.string())
+            schema = pa.schema(list(zip(columns, types)))
+            writer = pa.ipc.new_stream(out, schema)
+
+        arrays = []
+        for column, field in zip(values, schema):
+            if field.type == pa.string():
+                column = [None if value is None else str(value) for value in column]
+            else:
+                for value in column:
+                    if not isinstance(value, (int, float)) and value not in MISSING_VALUES:
+                        writer.close()
+                        raise ValueError(f"Column {field.name} is numeric in the first rows but holds {value!r} after {count} rows")
+                column = [float(value) if isinstance(value, (int, float)) else None for value in column]
+            arrays.append(pa.array(column, type=field.type))
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        count += len(chunk)
+
+    #An empty result is written as a stream with string columns and no batches
+    if writer is None:
+        writer = pa.ipc.new_stream(out, pa.schema([(column, pa.string()) for column in columns]))
+    writer.close()
+    return count
+
+#Output formats of query results, and whether the format is binary
+RESULT_FORMATS = {
+    'text': (write_text, False),
+    'tsv': (write_tsv, False),
+    'csv': (write_csv, False),
+    'jsonl': (write_jsonl, False),
+    'arrow': (write_arrow, True),
+}
+
+#Helper function to choose the output format from the --format option or the extension of the output file
+def result_format(fmt, output):
+    if fmt:
+        return fmt
+    extension = os.path.splitext(output or '')[1].lstrip('.').lower()
+    return {'tsv': 'tsv', 'csv': 'csv', 'jsonl': 'jsonl', 'arrow': 'arrow', 'arrows': 'arrow'}.get(extension, 'text')
+
+#Helper function to split an iterable into lists of at most size items
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+#Subject covariates that features can be correlated with or plotted against
+COVARIATES = ['Age', 'BMI', 'SSPG']
+
+#Subject columns that plots can be split into subsets by
+SUBJECT_GROUPS = ['Sex', 'InsulinSensitivity']
+
+#Number of features per block of the correlation engine, and number of pairs written by default
+CORRELATION_BLOCK_SIZE = 512
+DEFAULT_TOP_K = 100
+
+#Helper function to sort the values of every feature and find their runs of tied values, for ranking
+#values has one row per feature; returns the order of the values of every row, and for every position in this order
+#the first and last positions of its run. Missing values are sorted last and each one is a run of its own
+def rank_runs(values):
+    import numpy as np
+
+    order = np.argsort(values, axis=1, kind='mergesort')
+    ordered = np.take_along_axis(values, order, axis=1)
+    positions = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    starts = np.ones(values.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends = np.ones(values.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, values.shape[1])[:, ::-1], axis=1)[:, ::-1]
+    return order, first, last
+
+#Helper function to rank the values of features over a subset of the samples, given their rank_runs
+#selected has one row of selected samples per feature, and the runs have one row per row of selected, or a single row
+#that is ranked over every row of selected. Tied values get the average of their ranks
+#The ranks of the samples that are not selected are not meaningful
+def subset_ranks(order, first, last, selected):
+    import numpy as np
+
+    #The rows are flattened, so that the sorted values of every row are gathered with one take
+    features, samples = selected.shape
+    if order.ndim == 1:
+        chosen = selected[:, order]
+    else:
+        flat_order = (order + np.arange(0, features * samples, samples, dtype=order.dtype)[:, None]).ravel()
+        chosen = selected.ravel().take(flat_order).reshape(features, samples)
+
+    #Number of selected samples before every position of the sorted rows
+    before = np.zeros((features, samples + 1), dtype=np.int32)
+    np.cumsum(chosen, axis=1, out=before[:, 1:])
+
+    #A value ranks after the selected values of the runs before its run, in the middle of the selected values of its run
+    if order.ndim == 1:
+        below = before[:, first]
+        ordered_ranks = below + (before[:, last + 1] - below + 1) / 2
+        ranks = np.empty((features, samples))
+        ranks[:, order] = ordered_ranks
+        return ranks
+    offsets = np.arange(0, features * (samples + 1), samples + 1, dtype=first.dtype)[:, None]
+    below = before.ravel().take((first + offsets).ravel())
+    ordered_ranks = below + (before.ravel().take((last + 1 + offsets).ravel()) - below + 1) / 2
+    ranks = np.empty(features * samples)
+    ranks[flat_order] = ordered_ranks
+    return ranks.reshape(features, samples)
+
+#Helper function to replace the values of every column of a block by their ranks, for Spearman correlation
+#Tied values get the average of their ranks; missing values stay NaN
+def rank_columns(block):
+    import numpy as np
+
+    values = np.ascontiguousarray(block.T)
+    present = ~np.isnan(values)
+    return np.where(present, subset_ranks(*rank_runs(values), present), np.nan).T
+
+#Helper function computing the Spearman correlation of source feature i with some target features, each pair over the
+#samples where both are measured; both features of a pair are ranked again over these samples
+#x and y have one row per feature, and x_runs and y_runs are their rank_runs, so no feature is sorted again for every pair
+def pairwise_spearman(x, x_runs, i, y, y_runs, columns):
+    import numpy as np
+
+    selected = ~np.isnan(y[columns]) & ~np.isnan(x[i])
+    x_ranks = subset_ranks(*(runs[i] for runs in x_runs), selected)
+    y_ranks = subset_ranks(*(runs[columns] for runs in y_runs), selected)
+
+    #The ranks of n samples average (n + 1) / 2
+    count = selected.sum(axis=1)
+    middle = ((count + 1) / 2)[:, None]
+    x_ranks = np.where(selected, x_ranks - middle, 0)
+    y_ranks = np.where(selected, y_ranks - middle, 0)
+    covariance = np.einsum('ij,ij->i', x_ranks, y_ranks)
+    variance = np.einsum('ij,ij->i', x_ranks, x_ranks) * np.einsum('ij,ij->i', y_ranks, y_ranks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.where(variance > 0, covariance / np.sqrt(variance), np.nan)
+    return np.clip(correlation, -1, 1)
+
+#Helper function to read a block of columns of a memory-mapped matrix, restricted to the aligned rows
+def read_block(matrix, rows, start, stop):
+    import numpy as np
+
+    block = np.asarray(matrix[:, start:stop], dtype=np.float64)
+    return block if rows is None else block[rows]
+
+#Helper function computing the pairwise-complete Pearson correlation of every column of x with every column of y
+#Both blocks are centered and their missing values set to 0, so every sum is a matrix product over the samples
+#Returns the correlation matrix and the matrix of the number of samples of every pair
+def block_correlation(x, y):
+    import numpy as np
+
+    x_present = (~np.isnan(x)).astype(np.float64)
+    y_present = (~np.isnan(y)).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        #Centering does not change the correlation, and keeps the sums of squares from cancelling
+        x = np.nan_to_num(x - np.nanmean(x, axis=0))
+        y = np.nan_to_num(y - np.nanmean(y, axis=0))
+
+        count = x_present.T @ y_present
+        sum_x = x.T @ y_present
+        sum_y = x_present.T @ y
+        sum_xx = (x * x).T @ y_present
+        sum_yy = x_present.T @ (y * y)
+        sum_xy = x.T @ y
+
+        covariance = count * sum_xy - sum_x * sum_y
+        variance = (count * sum_xx - sum_x * sum_x) * (count * sum_yy - sum_y * sum_y)
+        correlation = np.where(variance > 0, covariance / np.sqrt(variance), np.nan)
+    return np.clip(correlation, -1, 1), count
+
+#Helper function correlating one block of source features with the target features from a given column onwards
+#Run in a worker process; the matrices are memory-mapped .npy files, so only one source and one target block are in memory
+#For Spearman, the matrices hold the ranks of every feature over its measured samples; pairs of features that are not
+#measured in the same samples are ranked again over the samples they have in common
+#Returns the (source index, target index, correlation, samples) of the pairs that pass the threshold,
+#only the top_k strongest ones if top_k is given
+def correlate_block(task):
+    import numpy as np
+
+    source = np.load(task['source_path'], mmap_mode='r')
+    target = np.load(task['target_path'], mmap_mode='r')
+    block_size = task['block_size']
+    start, stop = task['start'], min(task['start'] + block_size, source.shape[1])
+    x = read_block(source, task['source_rows'], start, stop)
+
+    kept = [np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)]
+    for target_start in range(task['target_start'], target.shape[1], block_size):
+        target_stop = min(target_start + block_size, target.shape[1])
+        y = read_block(target, task['target_rows'], target_start, target_stop)
+        correlation, count = block_correlation(x, y)
+
+        #For Spearman, pairs of features that are not measured in the same samples are correlated again, ranked over the samples
+        #they have in common
+        if task['method'] == 'spearman':
+            x_present = (~np.isnan(x)).astype(np.float64)
+            y_present = (~np.isnan(y)).astype(np.float64)
+            unmatched = (x_present.T @ (1 - y_present) + (1 - x_present).T @ y_present > 0) & (count >= task['min_samples'])
+            if task['same_matrix']:
+                unmatched &= (np.arange(start, stop)[:, None] < np.arange(target_start, target_stop)[None, :])
+            if unmatched.any():
+                x_features, y_features = np.ascontiguousarray(x.T), np.ascontiguousarray(y.T)
+                x_runs, y_runs = rank_runs(x_features), rank_runs(y_features)
+                for i in np.flatnonzero(unmatched.any(axis=1)):
+                    columns = np.flatnonzero(unmatched[i])
+                    correlation[i, columns] = pairwise_spearman(x_features, x_runs, i, y_features, y_runs, columns)
+
+        valid = ~np.isnan(correlation) & (count >= task['min_samples'])
+        if task['threshold'] is not None:
+            valid &= np.abs(correlation) >= task['threshold']
+        #Within one table, every pair is only computed once and features are not paired with themselves
+        if task['same_matrix']:
+            valid &= (np.arange(start, stop)[:, None] < np.arange(target_start, target_stop)[None, :])
+
+        source_index, target_index = np.nonzero(valid)
+        kept = [np.concatenate(values) for values in zip(kept, (
+            source_index + start, target_index + target_start, correlation[valid], count[valid]))]
+        if task['top_k'] is not None and len(kept[2]) > task['top_k']:
+            strongest = np.argpartition(-np.abs(kept[2]), task['top_k'])[:task['top_k']]
+            kept = [values[strongest] for values in kept]
+
+    return [(int(i), int(j), float(r), int(n)) for i, j, r, n in zip(*kept)]
+
+#Number of SQLite virtual machine instructions between calls of the progress handler when profiling
+PROGRESS_STEPS = 1000
+
+#Helper function to reduce the start of an SQL statement to its verb and table, e.g. 'INSERT TranscriptSamples'
+@functools.lru_cache(maxsize=1024)
+def statement_key(sql):
+    match = re.match(r'\s*(\w+)(?:.*?\b(?:INTO|FROM|TABLE|UPDATE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([\w.]+))?', sql,
+                     re.IGNORECASE | re.DOTALL)
+    if not match:
+        return sql.strip()[:40]
+    verb, table = match.groups()
+    return f'{verb.upper()} {table}' if table else verb.upper()
+
+#Class collecting the instrumentation of a DatabaseManager run: per-stage wall and CPU timers, counters,
+#and SQLite statement counts, spans and virtual machine steps from the trace callback and progress handler
+class Profiler:
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.statements = {}
+
+        #Statement currently executing, according to the trace callback
+        self.current = None
+        self.current_start = None
+
+    #Context manager timing a stage; repeated stages are accumulated
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.finish_statement()
+            entry = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            entry['calls'] += 1
+            entry['wall_seconds'] += time.perf_counter() - start_wall
+            entry['cpu_seconds'] += time.process_time() - start_cpu
+
+    #Method for adding to a counter such as rows:TranscriptSamples or bytes_read:Subject.csv
+    def count(self, name, amount):
+        self.counters[name] += amount
+
+    #Method for installing the trace callback and progress handler on a connection
+    def attach(self, connection):
+        connection.set_trace_callback(self.trace)
+        connection.set_progress_handler(self.progress, PROGRESS_STEPS)
+
+    #Trace callback, called by SQLite when a statement starts
+    #SQLite does not report when a statement ends, so the span of a statement runs until the next statement starts or the
+    #current stage ends, and includes the Python work done in between; the virtual machine steps count the SQLite work
+    #Only the start of the statement is looked at, because the statement text includes the bound values
+    def trace(self, sql):
+        now = time.perf_counter()
+        if self.current is not None:
+            self.statements[self.current]['span_seconds'] += now - self.current_start
+        key = statement_key(sql[:200].lstrip()[:48])
+        entry = self.statements.get(key)
+        if entry is None:
+            entry = self.statements[key] = {'count': 0, 'span_seconds': 0.0, 'vm_steps': 0}
+        entry['count'] += 1
+        self.current = key
+        self.current_start = now
+
+    #Method for adding the time since the statement that is executing started to its span
+    def finish_statement(self):
+        if self.current is not None:
+            self.statements[self.current]['span_seconds'] += time.perf_counter() - self.current_start
+            self.current = None
+
+    #Progress handler, called by SQLite every PROGRESS_STEPS instructions; returning 0 lets the statement continue
+    def progress(self):
+        if self.current is not None:
+            self.statements[self.current]['vm_steps'] += PROGRESS_STEPS
+        return 0
+
+    #Method returning the report as a dictionary
+    def report(self):
+        self.finish_statement()
+        statements = {key: dict(entry, avg_vm_steps=entry['vm_steps'] / entry['count'])
+                      for key, entry in sorted(self.statements.items(), key=lambda item: -item[1]['vm_steps'])}
+        report = {
+            'wall_seconds': time.perf_counter() - self.start_wall,
+            'cpu_seconds': time.process_time() - self.start_cpu,
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'statements': statements,
+        }
+        #Peak resident set size in kilobytes on Linux, of this process and of the parser processes
+        if resource is not None:
+            report['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report['peak_rss_children_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return report
+
+#Decorator timing a DatabaseManager method as a stage of the profiler, when profiling is enabled
+def profiled(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return method(self, *args, **kwargs)
+        with self.profiler.stage(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 #Creating the DatabaseManager class with various methods to create and interact with the database
 class DatabaseManager:
     #Initializing the DatabaseManager class with the specified SQLite database file.
-    def __init__(self, db_2875662):
+    def __init__(self, db_2875662, storage=None, batch_size=DEFAULT_BATCH_SIZE, read_only=False,
+                 mmap_mb=READ_ONLY_MMAP_MB, cache_mb=READ_ONLY_CACHE_MB, immutable=True):
         self.db_2875662 = db_2875662
 
+        #Whether the database is opened read-only, whether it is an immutable snapshot (otherwise it may be reloaded
+        #by another process while it is open), and the memory settings of the read-only connection
+        self.read_only = read_only
+        self.immutable = immutable
+        self.mmap_mb = mmap_mb
+        self.cache_mb = cache_mb
+
+        #Journal mode of the database before a bulk load, restored afterwards
+        self.journal_mode = None
+
+        #Number of rows per executemany batch, and whether a bulk load with fast pragmas is in progress
+        self.batch_size = batch_size
+        self.bulk_load = False
+
+        #FeatureIDs and abundance values of the rows written since the last flush of the feature summaries, by (table, SubjectID)
+        self.pending_summaries = {}
+
+        #Connection for queries, opened on first use
+        self.read_connection = None
+
+        #Feature columns of the wide abundance tables checked by render_query, with the schema version they were listed at
+        self.feature_cache = {}
+
+        #Options of the plots: the Subject column to split them into subsets by, the output file,
+        #whether to show them in a window, and the number of points above which a subset is drawn as a density
+        self.plot_options = {'group_by': None, 'output': None, 'show': False, 'density_threshold': None}
+
+        #Profiler collecting the instrumentation of this run, if enabled with enable_profiling
+        self.profiler = None
+
         #Establishing a connection to the SQlite database
-        self.connection = sqlite3.connect(self.db_2875662)
+        self.connection = self.connect_read_only() if read_only else sqlite3.connect(self.db_2875662)
 
         #Creating a cursor to execute SQL commands within the database
         self.cursor = self.connection.cursor()
 
+        #Storage layout of the abundance tables:
+        #'wide' stores one column per transcript/protein/peak, 'long' stores one row per (sample, feature) value
+        #If no layout is given, it is detected from the existing schema
+        self.storage = storage or self.detect_storage()
+
+    #Method for enabling the instrumentation of the connections and methods of this DatabaseManager
+    def enable_profiling(self):
+        self.profiler = Profiler()
+        self.profiler.attach(self.connection)
+        if self.read_connection is not None:
+            self.profiler.attach(self.read_connection)
+
+    #Method returning a timer for a part of a method, which does nothing when profiling is disabled
+    def timer(self, name):
+        return self.profiler.stage(name) if self.profiler else contextlib.nullcontext()
+
+    #Method for counting the bytes of an input file read from the given offset
+    def record_bytes_read(self, file_path, offset=0):
+        if self.profiler:
+            self.profiler.count(f'bytes_read:{os.path.basename(file_path)}', os.path.getsize(file_path) - (offset or 0))
+
+    #Method for writing the profile report as JSON
+    def write_profile(self, report_path):
+        with open(report_path, 'w') as report_file:
+            json.dump(self.profiler.report(), report_file, indent=2)
+
+    #Method for detecting the storage layout of an existing database
+    def detect_storage(self):
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Abundance'")
+        return 'long' if self.cursor.fetchone() else 'wide'
+
     #Creating a method for the creation of subject and annotation tables
     #Using the execute function to create the tables
+    @profiled
     def create_subject_annot(self):
         try:
             cursor = self.connection.cursor()
@@ -30,21 +863,21 @@ class DatabaseManager:
                     Sex TEXT,
                     Age INTEGER,
                     BMI REAL,
+                    SSPG REAL,
                     InsulinSensitivity TEXT
                 )
             ''')
 
-            #Combination of PeakID and metabolite name is used as the primary key
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS Annotation (
-                    PeakID TEXT,
-                    MetaboliteName TEXT,
-                    KEGG TEXT,
-                    ChemicalClass TEXT,
-                    Pathway TEXT,
-                    PRIMARY KEY (PeakID, MetaboliteName)
-                )
-            ''')
+            #Annotation tables of the metabolome peaks
+            self.create_annotation_tables()
+
+            #Tables listing the omics layers sampled at every visit and summarizing every feature per subject
+            self.create_sample_index()
+            self.create_feature_summary()
+
+            #Table recording the input files that have been loaded
+            self.create_manifest()
+
             #Commiting the changes to the database
             self.connection.commit()
         except sqlite3.Error as e:
@@ -53,12 +886,9 @@ class DatabaseManager:
         
         
     #Creating a method to create the abundance tables for protein, transcript and metabolite samples
+    @profiled
     def create_abundance(self, file_path, table_name):
 
-        #Helper function to ammend column names by replacing invalid characters
-        def new_column_name(column):
-            return column.replace("-", "_").replace(".", "_")
-
         try:
             #Creating a cursor to execute SQL commands
             cursor = self.connection.cursor()
@@ -92,6 +922,13 @@ class DatabaseManager:
                     # Adding the current name to the set of duplicates.
                     duplicates.add(name)
 
+                #In long storage the features become rows of the Feature table instead of columns
+                if self.storage == 'long':
+                    self.create_long_tables(table_name, abundance)
+                    self.create_sample_index()
+                    self.create_feature_summary()
+                    return abundance
+
                 # Creating the table query dynamically based on the column names.
                 create_table_query = f'''
                     CREATE TABLE IF NOT EXISTS {table_name} (
@@ -110,14 +947,656 @@ class DatabaseManager:
 
                 cursor.execute(create_table_query)
 
+                #Adding the columns of features that are new since the table was created, keeping the existing data
+                existing_columns = {name.lower() for name in self.table_features(table_name)}
+                for trans_name in abundance:
+                    if trans_name.lower() not in existing_columns:
+                        cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN {trans_name} REAL')
+
+                #Registering the columns of the table, so that its feature summaries can be keyed on FeatureID
+                self.create_feature_table()
+                self.register_features(table_name, self.table_features(table_name))
+
+                #Creating the SampleIndex and FeatureSummary tables if the database was created without them
+                self.create_sample_index()
+                self.create_feature_summary()
+
                 #Returning unique peak IDs/ protein names/ transcript names with alid characters
                 return abundance
         except sqlite3.Error as e:
             print(f"Error creating table: {e}")
             raise SystemExit(1)
-        
-        
+
+    #Creating a method to create the long (feature-indexed) storage tables
+    #Features and samples are integer-keyed dimension tables and every measurement is one (FeatureID, SampleKey, Value) row
+    #so the number of features is not limited by the SQLite column limit
+    def create_long_tables(self, table_name, column_names):
+        cursor = self.connection.cursor()
+        self.create_feature_table()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Sample (
+                SampleKey INTEGER PRIMARY KEY,
+                TableName TEXT NOT NULL,
+                SubjectID TEXT,
+                VisitID TEXT(100),
+                UNIQUE (TableName, SubjectID, VisitID),
+                FOREIGN KEY (SubjectID) REFERENCES Subject(SubjectID)
+            )
+        ''')
+
+        #The fact table is clustered by feature so a single-feature lookup only reads that feature's rows
+        #The secondary index covers lookups of all values of one sample
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Abundance (
+                FeatureID INTEGER NOT NULL,
+                SampleKey INTEGER NOT NULL,
+                Value REAL,
+                PRIMARY KEY (FeatureID, SampleKey),
+                FOREIGN KEY (FeatureID) REFERENCES Feature(FeatureID),
+                FOREIGN KEY (SampleKey) REFERENCES Sample(SampleKey)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_abundance_sample ON Abundance (SampleKey, FeatureID, Value)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sample_subject ON Sample (SubjectID, TableName, VisitID)')
+
+        #Registering the peakIDs/protein names/transcript names of this table
+        self.register_features(table_name, column_names)
+        self.connection.commit()
+
+    #Creating a method to create the Feature table, which gives every peakID/protein name/transcript name of every
+    #abundance table an integer key
+    #In long storage it is the feature dimension of the Abundance table; in both layouts FeatureSummary is keyed on it
+    def create_feature_table(self):
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS Feature (
+                FeatureID INTEGER PRIMARY KEY,
+                TableName TEXT NOT NULL,
+                FeatureName TEXT NOT NULL,
+                UNIQUE (TableName, FeatureName)
+            )
+        ''')
+
+    #Method for registering the features of an abundance table in the Feature table; features already registered keep their key
+    def register_features(self, table_name, column_names):
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO Feature (TableName, FeatureName) VALUES (?, ?)',
+            [(table_name, name) for name in column_names])
+
+    #Creating a method to create the annotation tables
+    #Metabolite names, chemical classes and pathways are integer-keyed dimension tables, and PeakAnnotation
+    #holds one (PeakID, MetaboliteID, KEGG, ClassID, PathwayID) row per annotation
+    #The KEGG ID stays on the annotation, because the same metabolite name can be annotated with different KEGG IDs
+    #PathwayCount and ClassCount hold the number of annotations of every pathway and class; they are maintained by triggers,
+    #so they are updated in the same transaction as the annotations
+    #Annotation is a view with the columns of the original table, and a database with the original table is converted
+    def create_annotation_tables(self):
+        cursor = self.connection.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Metabolite (
+                MetaboliteID INTEGER PRIMARY KEY,
+                MetaboliteName TEXT NOT NULL UNIQUE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ChemicalClass (
+                ClassID INTEGER PRIMARY KEY,
+                ChemicalClass TEXT NOT NULL UNIQUE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Pathway (
+                PathwayID INTEGER PRIMARY KEY,
+                Pathway TEXT NOT NULL UNIQUE
+            )
+        ''')
+
+        #Combination of PeakID and metabolite is used as the primary key
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS PeakAnnotation (
+                PeakID TEXT,
+                MetaboliteID INTEGER,
+                KEGG TEXT,
+                ClassID INTEGER,
+                PathwayID INTEGER,
+                PRIMARY KEY (PeakID, MetaboliteID),
+                FOREIGN KEY (MetaboliteID) REFERENCES Metabolite(MetaboliteID),
+                FOREIGN KEY (ClassID) REFERENCES ChemicalClass(ClassID),
+                FOREIGN KEY (PathwayID) REFERENCES Pathway(PathwayID)
+            )
+        ''')
+
+        for count_table, key in (('PathwayCount', 'PathwayID'), ('ClassCount', 'ClassID')):
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {count_table} (
+                    {key} INTEGER PRIMARY KEY,
+                    AnnotationCount INTEGER NOT NULL
+                )
+            ''')
+
+            #Counting every annotation that is inserted, deleted or moved to another pathway or class
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{count_table.lower()}_insert AFTER INSERT ON PeakAnnotation
+                WHEN NEW.{key} IS NOT NULL
+                BEGIN
+                    INSERT INTO {count_table} ({key}, AnnotationCount) VALUES (NEW.{key}, 1)
+                    ON CONFLICT ({key}) DO UPDATE SET AnnotationCount = AnnotationCount + 1;
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{count_table.lower()}_delete AFTER DELETE ON PeakAnnotation
+                WHEN OLD.{key} IS NOT NULL
+                BEGIN
+                    UPDATE {count_table} SET AnnotationCount = AnnotationCount - 1 WHERE {key} = OLD.{key};
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{count_table.lower()}_update AFTER UPDATE OF {key} ON PeakAnnotation
+                WHEN OLD.{key} IS NOT NEW.{key}
+                BEGIN
+                    UPDATE {count_table} SET AnnotationCount = AnnotationCount - 1 WHERE {key} = OLD.{key};
+                    INSERT INTO {count_table} ({key}, AnnotationCount) SELECT NEW.{key}, 1 WHERE NEW.{key} IS NOT NULL
+                    ON CONFLICT ({key}) DO UPDATE SET AnnotationCount = AnnotationCount + 1;
+                END
+            ''')
+
+        #Moving the rows of an Annotation table created before the dimension tables
+        cursor.execute("SELECT type FROM sqlite_master WHERE name = 'Annotation'")
+        existing = cursor.fetchone()
+        if existing and existing[0] == 'table':
+            cursor.execute('SELECT PeakID, MetaboliteName, KEGG, ChemicalClass, Pathway FROM Annotation')
+            write_rows = self.annotation_writer()
+            for batch in batched(cursor.fetchall(), self.batch_size):
+                write_rows(batch)
+            cursor.execute('DROP TABLE Annotation')
+
+        cursor.execute('''
+            CREATE VIEW IF NOT EXISTS Annotation AS
+            SELECT PeakAnnotation.PeakID, Metabolite.MetaboliteName, PeakAnnotation.KEGG, ChemicalClass.ChemicalClass, Pathway.Pathway
+            FROM PeakAnnotation
+            LEFT JOIN Metabolite ON Metabolite.MetaboliteID = PeakAnnotation.MetaboliteID
+            LEFT JOIN ChemicalClass ON ChemicalClass.ClassID = PeakAnnotation.ClassID
+            LEFT JOIN Pathway ON Pathway.PathwayID = PeakAnnotation.PathwayID
+        ''')
+        self.connection.commit()
+
+    #Creating a method that returns a function writing annotation rows
+    #The returned function takes a list of (PeakID, MetaboliteName, KEGG, ChemicalClass, Pathway) rows,
+    #adds the metabolites, classes and pathways that are not stored yet and upserts the annotations
+    def annotation_writer(self):
+        cursor = self.connection.cursor()
+
+        #The dimension tables are small, so their keys are kept in memory while loading
+        cursor.execute('SELECT MetaboliteName, MetaboliteID FROM Metabolite')
+        metabolites = dict(cursor.fetchall())
+        cursor.execute('SELECT ChemicalClass, ClassID FROM ChemicalClass')
+        classes = dict(cursor.fetchall())
+        cursor.execute('SELECT Pathway, PathwayID FROM Pathway')
+        pathways = dict(cursor.fetchall())
+
+        #Helper function returning the key of a metabolite, class or pathway, inserting it if it is new
+        def dimension_key(keys, table_name, column, value):
+            if value is None:
+                return None
+            if value not in keys:
+                cursor.execute(f'INSERT INTO {table_name} ({column}) VALUES (?)', (value,))
+                keys[value] = cursor.lastrowid
+            return keys[value]
+
+        insert_annotation_sql = '''
+            INSERT INTO PeakAnnotation (PeakID, MetaboliteID, KEGG, ClassID, PathwayID)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (PeakID, MetaboliteID) DO UPDATE SET
+                KEGG = excluded.KEGG, ClassID = excluded.ClassID, PathwayID = excluded.PathwayID
+        '''
+
+        def write_annotation_rows(annotation_rows):
+            cursor.executemany(insert_annotation_sql, [
+                (peak_id, dimension_key(metabolites, 'Metabolite', 'MetaboliteName', metabolite), kegg,
+                 dimension_key(classes, 'ChemicalClass', 'ChemicalClass', chem_class),
+                 dimension_key(pathways, 'Pathway', 'Pathway', pathway))
+                for peak_id, metabolite, kegg, chem_class, pathway in annotation_rows])
+            return len(annotation_rows)
+
+        return write_annotation_rows
+
+    #Creating a method to create the SampleIndex table
+    #SampleIndex has one narrow row per (SubjectID, VisitID) with a flag per abundance table that has a sample of that visit,
+    #so visit listings and omics coverage questions do not have to read the abundance tables
+    #A database loaded before the table existed is indexed from its abundance tables when the table is created
+    def create_sample_index(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'SampleIndex'")
+        if cursor.fetchone():
+            return
+
+        cursor.execute('''
+            CREATE TABLE SampleIndex (
+                SubjectID TEXT NOT NULL,
+                VisitID TEXT(100) NOT NULL,
+                has_transcript INTEGER NOT NULL DEFAULT 0,
+                has_protein INTEGER NOT NULL DEFAULT 0,
+                has_metabolite INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (SubjectID, VisitID),
+                FOREIGN KEY (SubjectID) REFERENCES Subject(SubjectID)
+            ) WITHOUT ROWID
+        ''')
+
+        for table_name in ABUNDANCE_TABLES:
+            if self.storage == 'long':
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Sample'")
+            else:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+            if cursor.fetchone():
+                self.index_samples(table_name, self.table_samples(table_name))
+        self.connection.commit()
+
+    #Method for flagging samples of an abundance table in the SampleIndex table
+    #Called with every batch written, in the same transaction as the abundance rows
+    def index_samples(self, table_name, rows):
+        flag = SAMPLE_INDEX_COLUMNS[table_name]
+        self.connection.executemany(f'''
+            INSERT INTO SampleIndex (SubjectID, VisitID, {flag})
+            VALUES (?, ?, 1)
+            ON CONFLICT (SubjectID, VisitID) DO UPDATE SET {flag} = 1
+        ''', ((row[0], row[1]) for row in rows))
+
+    #Creating a method to create the FeatureSummary table
+    #FeatureSummary holds the count, minimum, maximum, sum and sum of squares of the values of every feature for every subject,
+    #keyed on (SubjectID, FeatureID), so per-subject aggregates such as query 8 read one row instead of the subject's samples
+    #A database loaded before the table existed, or whose table was keyed on the feature names, is summarized again from its
+    #abundance tables when the table is created
+    def create_feature_summary(self):
+        cursor = self.connection.cursor()
+        self.create_feature_table()
+        cursor.execute('PRAGMA table_info(FeatureSummary)')
+        columns = [row[1] for row in cursor.fetchall()]
+        if 'FeatureID' in columns:
+            return
+        if columns:
+            cursor.execute('DROP TABLE FeatureSummary')
+
+        cursor.execute('''
+            CREATE TABLE FeatureSummary (
+                SubjectID TEXT NOT NULL,
+                FeatureID INTEGER NOT NULL,
+                ValueCount INTEGER NOT NULL,
+                MinValue REAL,
+                MaxValue REAL,
+                SumValue REAL,
+                SumSquares REAL,
+                PRIMARY KEY (SubjectID, FeatureID),
+                FOREIGN KEY (SubjectID) REFERENCES Subject(SubjectID),
+                FOREIGN KEY (FeatureID) REFERENCES Feature(FeatureID)
+            ) WITHOUT ROWID
+        ''')
+
+        for table_name, flag in SAMPLE_INDEX_COLUMNS.items():
+            cursor.execute(f'SELECT DISTINCT SubjectID FROM SampleIndex WHERE {flag} = 1')
+            subjects = [row[0] for row in cursor.fetchall()]
+            if subjects:
+                #The columns of a wide table written before the Feature table existed are registered first
+                if self.storage == 'wide':
+                    self.register_features(table_name, self.table_features(table_name))
+                self.summarize_subjects(table_name, subjects)
+        self.connection.commit()
+
+    #Method for finding the rows of a batch whose sample is already stored in an abundance table
+    #Must be called before the batch is written; returns the set of their SubjectIDs
+    def stored_subjects(self, table_name, rows):
+        flag = SAMPLE_INDEX_COLUMNS[table_name]
+        cursor = self.connection.cursor()
+        subjects = set()
+        for row in rows:
+            cursor.execute(f'SELECT {flag} FROM SampleIndex WHERE SubjectID = ? AND VisitID = ?', (row[0], row[1]))
+            stored = cursor.fetchone()
+            if stored and stored[0]:
+                subjects.add(row[0])
+        return subjects
+
+    #Method for buffering the rows of a written batch for the feature summaries of their subjects
+    #feature_keys are the FeatureIDs of the value columns of the rows
+    #The rows of a few subjects are kept in memory, so every feature of a subject is summarized once rather than per batch
+    #The summaries of subjects whose samples were replaced are recomputed from the stored values,
+    #because a replaced value cannot be taken out of a minimum or maximum
+    def summarize_batch(self, table_name, feature_keys, rows, replaced_subjects):
+        #A sample given twice in the batch replaces its first values as well
+        samples = set()
+        for row in rows:
+            if (row[0], row[1]) in samples:
+                replaced_subjects = set(replaced_subjects) | {row[0]}
+            samples.add((row[0], row[1]))
+
+        for row in rows:
+            if row[0] not in replaced_subjects:
+                self.pending_summaries.setdefault((table_name, row[0]), (feature_keys, []))[1].append(row[2:])
+
+        if replaced_subjects:
+            self.summarize_subjects(table_name, replaced_subjects)
+        if len(self.pending_summaries) > SUMMARY_BUFFER_SUBJECTS:
+            self.flush_summaries()
+
+    #Method for summarizing the buffered rows and merging the summaries into the FeatureSummary table
+    #Called before the loaded data is committed, so the summaries and the data are committed together
+    def flush_summaries(self):
+        #Subjects are merged in SubjectID order, which is the order of the FeatureSummary primary key
+        pending = sorted(self.pending_summaries.items(), key=lambda item: item[0][1])
+        self.connection.executemany('''
+            INSERT INTO FeatureSummary (SubjectID, FeatureID, ValueCount, MinValue, MaxValue, SumValue, SumSquares)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (SubjectID, FeatureID) DO UPDATE SET
+                ValueCount = ValueCount + excluded.ValueCount,
+                MinValue = MIN(MinValue, excluded.MinValue),
+                MaxValue = MAX(MaxValue, excluded.MaxValue),
+                SumValue = SumValue + excluded.SumValue,
+                SumSquares = SumSquares + excluded.SumSquares
+        ''', ((subject_id,) + summary
+              for (table_name, subject_id), (feature_keys, value_rows) in pending
+              for summary in summarize_samples(feature_keys, value_rows)))
+        self.pending_summaries.clear()
+
+    #Method for recomputing the FeatureSummary rows of some subjects from the values stored in an abundance table
+    def summarize_subjects(self, table_name, subjects):
+        cursor = self.connection.cursor()
+        if self.storage == 'wide':
+            cursor.execute('SELECT FeatureName, FeatureID FROM Feature WHERE TableName = ? ORDER BY FeatureID', (table_name,))
+            column_names, feature_keys = zip(*cursor.fetchall())
+
+        for subject_id in subjects:
+            #Buffered rows of the subject are part of the stored values
+            self.pending_summaries.pop((table_name, subject_id), None)
+            cursor.execute('''
+                DELETE FROM FeatureSummary
+                WHERE SubjectID = ? AND FeatureID IN (SELECT FeatureID FROM Feature WHERE TableName = ?)
+            ''', (subject_id, table_name))
+            if self.storage == 'long':
+                cursor.execute('''
+                    INSERT INTO FeatureSummary (SubjectID, FeatureID, ValueCount, MinValue, MaxValue, SumValue, SumSquares)
+                    SELECT Sample.SubjectID, Abundance.FeatureID,
+                        COUNT(*), MIN(Value), MAX(Value), SUM(Value), SUM(Value * Value)
+                    FROM Sample, Abundance
+                    WHERE Sample.TableName = ? AND Sample.SubjectID = ?
+                    AND Abundance.SampleKey = Sample.SampleKey
+                    AND typeof(Value) IN ('real', 'integer')
+                    GROUP BY Abundance.FeatureID
+                ''', (table_name, subject_id))
+            else:
+                cursor.execute(f'SELECT {", ".join(column_names)} FROM {table_name} WHERE SubjectID = ?', (subject_id,))
+                value_rows = cursor.fetchall()
+                if value_rows:
+                    cursor.executemany('''
+                        INSERT INTO FeatureSummary (SubjectID, FeatureID, ValueCount, MinValue, MaxValue, SumValue, SumSquares)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', [(subject_id,) + summary for summary in summarize_samples(feature_keys, value_rows)])
+
+    #Creating a method that returns a function writing parsed abundance rows into a table
+    #The returned function takes a list of rows and returns the number of database rows written
+    def abundance_writer(self, table_name, column_names):
+        cursor = self.connection.cursor()
+        self.create_table_versions()
+
+        #Long storage writes one row per measurement instead of one wide row per sample
+        if self.storage == 'long':
+            #Mapping each feature name to its integer key
+            cursor.execute('SELECT FeatureName, FeatureID FROM Feature WHERE TableName = ?', (table_name,))
+            feature_ids = dict(cursor.fetchall())
+            feature_keys = [feature_ids[name] for name in column_names]
+
+            def write_long_rows(abundance_data):
+                #Sample keys are assigned here so that samples and their values can be written in the same batch
+                #The next free key is looked up per batch because writers of several tables can be interleaved
+                cursor.execute('SELECT COALESCE(MAX(SampleKey), 0) FROM Sample')
+                sample_key = cursor.fetchone()[0]
+
+                samples = []
+                batch_keys = {}
+                sample_values = {}
+                replaced_subjects = set()
+                for data_row in abundance_data:
+                    #Samples seen earlier in the batch keep their key and have their queued values replaced
+                    row_key = batch_keys.get((data_row[0], data_row[1]))
+                    if row_key is None:
+                        #Samples that are already stored keep their key and have their old values replaced
+                        cursor.execute('''
+                            SELECT SampleKey FROM Sample
+                            WHERE TableName = ? AND SubjectID = ? AND VisitID = ?
+                        ''', (table_name, data_row[0], data_row[1]))
+                        existing = cursor.fetchone()
+                        if existing:
+                            row_key = existing[0]
+                            cursor.execute('DELETE FROM Abundance WHERE SampleKey = ?', (row_key,))
+                            replaced_subjects.add(data_row[0])
+                        else:
+                            sample_key += 1
+                            row_key = sample_key
+                            samples.append((row_key, table_name, data_row[0], data_row[1]))
+                        batch_keys[(data_row[0], data_row[1])] = row_key
+
+                    #Missing measurements are not stored, so the fact table stays sparse
+                    sample_values[row_key] = [(feature_key, row_key, value) for feature_key, value in zip(feature_keys, data_row[2:])
+                                              if value not in ('', 'NA')]
+                values = [value for row_values in sample_values.values() for value in row_values]
+
+                cursor.executemany('''
+                    INSERT INTO Sample (SampleKey, TableName, SubjectID, VisitID)
+                    VALUES (?, ?, ?, ?)
+                ''', samples)
+                cursor.executemany('INSERT INTO Abundance (FeatureID, SampleKey, Value) VALUES (?, ?, ?)', values)
+                self.bump_table_version(table_name)
+                self.index_samples(table_name, abundance_data)
+                self.summarize_batch(table_name, feature_keys, abundance_data, replaced_subjects)
+                return len(values)
+
+            return write_long_rows
+
+        #FeatureIDs of the columns, for the feature summaries; column names are not case sensitive
+        cursor.execute('SELECT FeatureName, FeatureID FROM Feature WHERE TableName = ?', (table_name,))
+        feature_ids = {name.lower(): feature_id for name, feature_id in cursor.fetchall()}
+        feature_keys = [feature_ids[name.lower()] for name in column_names]
+
+        # Creating the SQL query for inserting data into the specified table once for all rows.
+        # Samples that are already stored are updated with the new values.
+        placeholders = ', '.join(['?'] * (len(column_names) + 2))
+        insert_data_sql = f'''
+            INSERT INTO {table_name} ({', '.join(['SubjectID', 'VisitID'] + column_names)})
+            VALUES ({placeholders})
+            ON CONFLICT (SubjectID, VisitID) DO UPDATE SET {', '.join(f'{name} = excluded.{name}' for name in column_names)}
+        '''
+
+        def write_wide_rows(abundance_data):
+            replaced_subjects = self.stored_subjects(table_name, abundance_data)
+            cursor.executemany(insert_data_sql, abundance_data)
+            self.bump_table_version(table_name)
+            self.index_samples(table_name, abundance_data)
+            self.summarize_batch(table_name, feature_keys, abundance_data, replaced_subjects)
+            return len(abundance_data)
+
+        return write_wide_rows
+
+    #Creating a method to create the table of data versions, with a counter per abundance table
+    #Every written batch bumps the counter in the same transaction as its rows, so derived files can tell that the table changed
+    def create_table_versions(self):
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS TableVersion (
+                TableName TEXT PRIMARY KEY,
+                Version INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+
+    #Method for bumping the data version of a table
+    def bump_table_version(self, table_name):
+        self.connection.execute('''
+            INSERT INTO TableVersion (TableName, Version) VALUES (?, 1)
+            ON CONFLICT (TableName) DO UPDATE SET Version = Version + 1
+        ''', (table_name,))
+
+    #Method for the data version of a table, 0 for tables written before versions were kept
+    def table_version(self, table_name):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('SELECT Version FROM TableVersion WHERE TableName = ?', (table_name,))
+        except sqlite3.OperationalError:
+            return 0
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    #Method for the number of samples parsed and written per batch
+    #In long storage every sample expands into one row per feature, so the batch size is divided by the number of features
+    def abundance_batch_size(self, column_names):
+        if self.storage == 'long':
+            return max(1, self.batch_size // max(1, len(column_names)))
+        return self.batch_size
+
+    #Creating a method to create the load manifest table
+    #Every loaded input file is recorded with its size, modification time and content hash
+    def create_manifest(self):
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS LoadManifest (
+                FilePath TEXT PRIMARY KEY,
+                Size INTEGER,
+                MTime REAL,
+                SHA256 TEXT,
+                LoadedAt TEXT
+            )
+        ''')
+
+    #Creating a method to compare an input file with its entry in the load manifest
+    #Returns the fingerprint of the file and the byte offset to load it from:
+    #None if the file is unchanged, the previous size if rows were only appended, or 0 if it has to be loaded in full
+    @profiled
+    def file_changes(self, file_path):
+        self.create_manifest()
+        cursor = self.connection.cursor()
+        file_stat = os.stat(file_path)
+        cursor.execute('SELECT Size, MTime, SHA256 FROM LoadManifest WHERE FilePath = ?', (os.path.abspath(file_path),))
+        previous = cursor.fetchone()
+
+        #Files with the same size and modification time are not read again
+        if previous and previous[0] == file_stat.st_size and previous[1] == file_stat.st_mtime:
+            return (file_stat.st_size, file_stat.st_mtime, previous[2]), None
+
+        #Hashing the file, and the part of it that was loaded previously
+        digest = hashlib.sha256()
+        prefix_hash = None
+        boundary = b''
+        read = 0
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                if previous and read < previous[0] <= read + len(block):
+                    prefix = digest.copy()
+                    prefix.update(block[:previous[0] - read])
+                    prefix_hash = prefix.hexdigest()
+                    boundary = block[previous[0] - read - 1:previous[0] - read]
+                digest.update(block)
+                read += len(block)
+        fingerprint = (file_stat.st_size, file_stat.st_mtime, digest.hexdigest())
+
+        if previous is None:
+            return fingerprint, 0
+        #Only the modification time changed
+        if fingerprint[2] == previous[2]:
+            self.record_manifest(file_path, fingerprint)
+            self.connection.commit()
+            return fingerprint, None
+        #The previous content is unchanged and new lines were added after it
+        if prefix_hash == previous[2] and boundary == b'\n':
+            return fingerprint, previous[0]
+        return fingerprint, 0
+
+    #Creating a method to record a loaded file in the load manifest
+    #Called before the commit of the loaded data, so the manifest and the data are committed together
+    def record_manifest(self, file_path, fingerprint):
+        self.connection.execute('''
+            INSERT INTO LoadManifest (FilePath, Size, MTime, SHA256, LoadedAt)
+            VALUES (?, ?, ?, ?, datetime('now'))
+            ON CONFLICT (FilePath) DO UPDATE SET
+                Size = excluded.Size, MTime = excluded.MTime, SHA256 = excluded.SHA256, LoadedAt = excluded.LoadedAt
+        ''', (os.path.abspath(file_path),) + fingerprint)
+
+    #Method for opening an input file after its header, positioned at the given byte offset
+    #Returns the open file and the header line
+    def open_from_offset(self, file_path, offset):
+        file = open(file_path, encoding='utf-8')
+        header = file.readline()
+        if offset:
+            file.seek(offset)
+        return file, header
+
+    #Creating a method to build the secondary indexes of the query catalogue and refresh the planner statistics
+    @profiled
+    def create_indexes(self):
+        try:
+            cursor = self.connection.cursor()
+            for index_name, table_name, columns in INDEXES:
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})')
+            cursor.execute('ANALYZE')
+            self.connection.commit()
+        except sqlite3.Error as e:
+            print(f"Error creating indexes: {e}")
+
+    #Creating a method to drop the secondary indexes before a bulk load
+    def drop_indexes(self):
+        for index_name, _, _ in INDEXES:
+            self.cursor.execute(f'DROP INDEX IF EXISTS {index_name}')
+        self.connection.commit()
+
+    #Method for printing the query plan of every query in the catalogue
+    #Steps that scan a whole table without an index are flagged
+    def explain_queries(self):
+        for name, query in QUERY_CATALOGUE.items():
+            print(f"Query {query['number']} ({name}):" if 'number' in query else f"Query {name}:")
+            try:
+                sql, params = self.render_query(name)
+                for _, _, _, detail in self.get_read_connection().execute(f'EXPLAIN QUERY PLAN {sql}', params):
+                    full_scan = detail.startswith('SCAN') and 'INDEX' not in detail and 'CONSTANT ROW' not in detail
+                    print(f"    {detail}{'    <-- full table scan' if full_scan else ''}")
+            except sqlite3.Error as e:
+                print(f"    Error explaining query: {e}")
+
+    #Creating a method to switch the connection to fast load-time settings
+    #The journal is kept in memory and syncing is skipped, so an interrupted load must be rerun
+    #A database in WAL mode, which may be read by a query server during the load, stays in WAL mode
+    def begin_bulk_load(self):
+        self.bulk_load = True
+        self.journal_mode = self.cursor.execute('PRAGMA journal_mode').fetchone()[0]
+        if self.journal_mode != 'wal':
+            self.cursor.execute('PRAGMA journal_mode = MEMORY')
+        self.cursor.execute('PRAGMA synchronous = OFF')
+        self.cursor.execute('PRAGMA cache_size = -262144')
+        self.cursor.execute('PRAGMA temp_store = MEMORY')
+
+    #Creating a method to restore the safe settings after a bulk load
+    def end_bulk_load(self):
+        self.bulk_load = False
+        self.connection.commit()
+        if self.journal_mode != 'wal':
+            self.cursor.execute('PRAGMA journal_mode = DELETE')
+        self.cursor.execute('PRAGMA synchronous = FULL')
+        self.cursor.execute('PRAGMA cache_size = -2000')
+        self.cursor.execute('PRAGMA temp_store = DEFAULT')
+
+    #Method for printing the load throughput of a table during a bulk load
+    #The rows are also counted by the profiler
+    def report_load_rate(self, table_name, row_count, start):
+        if self.profiler:
+            self.profiler.count(f'rows:{table_name}', row_count)
+        if self.bulk_load:
+            elapsed = time.perf_counter() - start
+            rate = row_count / elapsed if elapsed > 0 else float('inf')
+            print(f"{table_name}: {row_count} rows in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+
+    #Method for adding the SSPG column to a Subject table created without it
+    #Returns True if the column was added
+    def add_sspg_column(self):
+        self.cursor.execute('PRAGMA table_info(Subject)')
+        if any(row[1].lower() == 'sspg' for row in self.cursor.fetchall()):
+            return False
+        self.cursor.execute('ALTER TABLE Subject ADD COLUMN SSPG REAL')
+        return True
+
     #Creating a method to load data into the subject table
+    @profiled
     def insert_subject(self, subject_file):
         try:
             # Checking if a connection exists, if not, establishing a new one.
@@ -125,89 +1604,238 @@ class DatabaseManager:
                 self.connection = sqlite3.connect(self.db_2875662)
                 self.cursor = self.connection.cursor()
 
+            #Skipping the file if it is unchanged since the last load, or reading only the appended lines
+            #A Subject table created without the SSPG column gets the column, and the file is loaded again in full
+            fingerprint, offset = self.file_changes(subject_file)
+            if self.add_sspg_column():
+                offset = 0
+            if offset is None:
+                print(f"Skipping unchanged file {subject_file}")
+                return
+
+            start = time.perf_counter()
+            row_count = 0
+
             #Reading the subject file
-            with open(subject_file, 'r') as file:
-                #skipping the header
-                next(file)
-
-                #Iterating over the subject file
-                for line in file:
-                    line = line.strip().split(',')
-
-                    #Setting the NA and Unknown values to none
-                    for i in range(len(line)):
-                        if line[i] in ['NA', 'Unknown']:
-                            line[i] = None
-                    #Extracting the subject_id, sex, age, bmi, insulin_sensitivity values
-                    subject_id, race, sex, age, bmi, sspg, insulin_sensitivity = line
-
-                    # Executing the SQL query to insert data into the Subject table.
-                    self.cursor.execute('''
-                        INSERT OR IGNORE INTO Subject (SubjectID, Sex, Age, BMI, InsulinSensitivity)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (subject_id, sex, age, bmi, insulin_sensitivity))
-            # Committing changes to the database.
+            #skipping the header
+            file, header = self.open_from_offset(subject_file, offset)
+            with file:
+                #Generator over the parsed rows of the subject file
+                def subject_rows():
+                    for line in file:
+                        line = line.strip().split(',')
+
+                        #Setting the NA and Unknown values to none
+                        for i in range(len(line)):
+                            if line[i] in ['NA', 'Unknown']:
+                                line[i] = None
+                        #Extracting the subject_id, sex, age, bmi, insulin_sensitivity values
+                        subject_id, race, sex, age, bmi, sspg, insulin_sensitivity = line
+                        yield subject_id, sex, age, bmi, sspg, insulin_sensitivity
+
+                # Inserting the rows into the Subject table in batches.
+                for batch in batched(subject_rows(), self.batch_size):
+                    self.cursor.executemany('''
+                        INSERT INTO Subject (SubjectID, Sex, Age, BMI, SSPG, InsulinSensitivity)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (SubjectID) DO UPDATE SET
+                            Sex = excluded.Sex, Age = excluded.Age, BMI = excluded.BMI, SSPG = excluded.SSPG,
+                            InsulinSensitivity = excluded.InsulinSensitivity
+                    ''', batch)
+                    row_count += len(batch)
+            # Committing changes to the database together with the manifest entry.
+            self.record_manifest(subject_file, fingerprint)
+            self.record_bytes_read(subject_file, offset)
             self.connection.commit()
+            self.report_load_rate('Subject', row_count, start)
         except sqlite3.Error as e:
+            self.connection.rollback()
             print(f"Error loading subject data: {e}")
         
 
+    #Creating a method to stream the parsed rows of an abundance file
+    #Lines before the byte offset are skipped
+    def read_abundance(self, file_path, chunk_size, offset=0):
+        #Reading the abundance files
+        trans_file, header = self.open_from_offset(file_path, offset)
+        with trans_file:
+            #Finding the position of the SampleID column in the header
+            sample_index = header.rstrip().split('\t').index('SampleID')
+
+            #Parsing the lines chunk by chunk
+            for lines in batched(trans_file, chunk_size):
+                yield from parse_abundance_lines(lines, sample_index)
+
     #Creating a method to insert data into the abundance tables
+    @profiled
     def insert_abundance(self, file_path, table_name, column_names):
         try:
-            #Creating a cursor to execute SQL commands
-            cursor = self.connection.cursor()
-
-            #Reading the abundance files
-            with open(file_path) as trans_file:
-                #Skipping the header
-                #Making a list of all the headers
-                header = next(trans_file)
-                headers = header.rstrip().split('\t')
-                headers[headers.index('SampleID')] = 'SubjectID'
-
-                # Initializing a list to store the abundance data.
-                #Iterating over each line
-                abundance_data = []
-                for trans_exp in trans_file:
-                    data = trans_exp.rstrip().split('\t')
-
-                    #Extracting the subjectID and visitID from the sampleID column
-                    subject_id, *visit_id = data[headers.index('SubjectID')].replace('-', '_').split('_')
-                    # Appending the processed data to the abundance_data list.
-                    abundance_data.append([subject_id, '_'.join(visit_id)] + data[1:])
-
-                # Iterating over the processed abundance data and insert into the specified table.
-                for data_row in abundance_data:
-                    # Creating placeholders for the SQL query.
-                    placeholders = ', '.join(['?'] * len(data_row))
-                    # Creating the SQL query for inserting data into the specified table.
-                    insert_data_sql = f'''
-                        INSERT INTO {table_name} ({', '.join(['SubjectID', 'VisitID'] + column_names)})
-                        VALUES ({placeholders})
-                    '''
-                    # Executing the SQL query to insert data into the table.
-                    cursor.execute(insert_data_sql, data_row)
+            #Skipping the file if it is unchanged since the last load, or reading only the appended samples
+            fingerprint, offset = self.file_changes(file_path)
+            if offset is None:
+                print(f"Skipping unchanged file {file_path}")
+                return
+
+            start = time.perf_counter()
+            row_count = 0
+
+            # Streaming the processed abundance data into the table in batches.
+            # Parsing (including the SampleID splitting) and writing are timed separately when profiling.
+            write_rows = self.abundance_writer(table_name, column_names)
+            chunk_size = self.abundance_batch_size(column_names)
+            batches = batched(self.read_abundance(file_path, chunk_size, offset), chunk_size)
+            while True:
+                with self.timer(f'insert_abundance:parse:{table_name}'):
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                with self.timer(f'insert_abundance:write:{table_name}'):
+                    row_count += write_rows(batch)
+            self.record_bytes_read(file_path, offset)
+
+            # Committing the whole file, its feature summaries and its manifest entry as a single transaction.
+            self.flush_summaries()
+            self.record_manifest(file_path, fingerprint)
+            self.connection.commit()
+            self.report_load_rate(table_name, row_count, start)
         except sqlite3.Error as e:
+            self.connection.rollback()
+            self.pending_summaries.clear()
             print(f"Error inserting data: {e}")
         
+    #Creating a method to load several abundance files in parallel
+    #A pool of worker processes parses the files while this connection is the only writer
+    #files is a list of (file_path, table_name, column_names) tuples
+    @profiled
+    def insert_abundance_parallel(self, files, jobs):
+        #Bounded queue between the parsers and the writer, so parsing cannot run far ahead of the database
+        parsed = queue.Queue(maxsize=2 * jobs)
+        stop = threading.Event()
+        producer = None
+
+        try:
+            #Skipping unchanged files and finding the offset to read the others from
+            changes = {}
+            for file_path, table_name, column_names in files:
+                fingerprint, offset = self.file_changes(file_path)
+                if offset is None:
+                    print(f"Skipping unchanged file {file_path}")
+                else:
+                    changes[file_path] = (fingerprint, offset)
+            files = [file for file in files if file[0] in changes]
+            offsets = {file_path: offset for file_path, (_, offset) in changes.items()}
+
+            start = time.perf_counter()
+            writers = {table_name: self.abundance_writer(table_name, column_names) for _, table_name, column_names in files}
+            row_counts = dict.fromkeys(writers, 0)
+            producer = threading.Thread(target=self.parse_abundance_files, args=(files, offsets, jobs, parsed, stop),
+                                        daemon=True)
+            producer.start()
+
+            #Writing the parsed batches in the order they arrive until the producer is done
+            while True:
+                item = parsed.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                table_name, rows = item
+                with self.timer(f'insert_abundance:write:{table_name}'):
+                    row_counts[table_name] += writers[table_name](rows)
+
+            # Committing all files, their feature summaries and their manifest entries as a single transaction.
+            self.flush_summaries()
+            for file_path, (fingerprint, offset) in changes.items():
+                self.record_manifest(file_path, fingerprint)
+                self.record_bytes_read(file_path, offset)
+            self.connection.commit()
+            for table_name, row_count in row_counts.items():
+                self.report_load_rate(table_name, row_count, start)
+        #Failures of the worker processes, such as a broken pool, are passed back through the queue and rolled back here as well
+        except Exception as e:
+            self.connection.rollback()
+            self.pending_summaries.clear()
+            print(f"Error inserting data: {e}")
+        finally:
+            #Releasing the producer if the writer stopped early
+            stop.set()
+            if producer is not None:
+                producer.join()
+
+    #Method run by the producer thread of insert_abundance_parallel
+    #Chunks of all files are submitted round-robin to the process pool and the parsed rows are put on the queue
+    def parse_abundance_files(self, files, offsets, jobs, parsed, stop):
+        #Helper function to put an item on the queue unless the writer has stopped
+        def put(item):
+            while not stop.is_set():
+                try:
+                    parsed.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        #Generator submitting the chunks of one file to the pool as it is advanced
+        def submit_chunks(pool, file_path, table_name, column_names):
+            trans_file, header = self.open_from_offset(file_path, offsets[file_path])
+            with trans_file:
+                sample_index = header.rstrip().split('\t').index('SampleID')
+                for lines in batched(trans_file, self.abundance_batch_size(column_names)):
+                    yield table_name, pool.submit(parse_abundance_lines, lines, sample_index)
+
+        try:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                readers = collections.deque(submit_chunks(pool, *file) for file in files)
+                pending = collections.deque()
+                while readers or pending:
+                    #Keeping up to two chunks per worker in flight
+                    while readers and len(pending) < 2 * jobs:
+                        reader = readers.popleft()
+                        chunk = next(reader, None)
+                        if chunk is not None:
+                            pending.append(chunk)
+                            readers.append(reader)
+
+                    table_name, future = pending.popleft()
+                    if not put((table_name, future.result())):
+                        for _, future in pending:
+                            future.cancel()
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
+
     #Creating a method to insert data into the Annotation table
+    @profiled
     def insert_annotation(self, annotation_file):
         try:
             if not self.connection:
                 self.connection = sqlite3.connect(self.db_2875662)
                 self.cursor = self.connection.cursor()
 
-            with open("HMP_metabolome_annotation.csv") as annot_file:
-                header = next(annot_file) #skipping the header
-                for annot in annot_file:
+            #Creating the annotation tables, or converting an Annotation table created before them
+            self.create_annotation_tables()
+
+            #Skipping the file if it is unchanged since the last load, or reading only the appended lines
+            fingerprint, offset = self.file_changes(annotation_file)
+            if offset is None:
+                print(f"Skipping unchanged file {annotation_file}")
+                return
+
+            start = time.perf_counter()
+            row_count = 0
+
+            #Rows are collected and written with executemany once a full batch is reached
+            annotation_rows = []
+            write_rows = self.annotation_writer()
+
+            annot_file, header = self.open_from_offset(annotation_file, offset) #skipping the header
+            with annot_file:
+                #Parsing the lines with the csv module, so quoted values containing commas are read correctly
+                for annot in csv.reader(annot_file):
                     try:
-                        annot = annot.rstrip().split(',')
-                        
                         #setting the empty values to None
-                        for i in range(len(annot)):
-                            if annot[i] == '':
-                                annot[i] = None
+                        annot = [value or None for value in annot]
                         #extracting the peak_id, metabolite_name, kegg, hmdb, chem_class, pathway values
                         peak_id, metabolite_name, kegg, hmdb, chem_class, pathway = annot[0], annot[1], annot[2], annot[3], annot[4], annot[5]
 
@@ -219,7 +1847,6 @@ class DatabaseManager:
 
                         #differentiating the metabolites and their respective kegg ids with the same peak_id seperated with a pipe
                         #so each metabolite is inserted into a seperate row
-                        #using the insert_db method to insert the data complying with each condition
                         if metabolite is not None and ('|' in metabolite):
                             metabolite_list = metabolite.split('|')
                             
@@ -227,201 +1854,614 @@ class DatabaseManager:
                                 kegg_list = kegg.split('|')
                                 
                                 for a, b in zip(metabolite_list, kegg_list):
-                                    self.cursor.execute('''INSERT INTO Annotation (PeakID, MetaboliteName, KEGG,  ChemicalClass, Pathway)
-                                        VALUES (?, ?, ?, ?, ?);
-                                    ''', (peak_id, a, b, chem_class, pathway))
-                                    #print(f'Inserted values: PeakID={peak_id}\tMetaboliteName={a}\tKEGG={b}\tHMDB={hmdb}\tChemicalClass={chem_class}\tPathway={pathway}')
+                                    annotation_rows.append((peak_id, a, b, chem_class, pathway))
                             #if kegg value is none        
                             else:
                             
                                 for a in metabolite_list:
-                                    self.cursor.execute('''
-                                        INSERT INTO Annotation (PeakID, MetaboliteName, KEGG, ChemicalClass, Pathway)
-                                        VALUES (?, ?, ?, ?, ?);
-                                    ''', (peak_id, a, kegg, chem_class, pathway))
-                                    #print(f'Inserted values: PeakID={peak_id}\tMetaboliteName={a}\tKEGG={kegg}\tHMDB={hmdb}\tChemicalClass={chem_class}\tPathway={pathway}')
+                                    annotation_rows.append((peak_id, a, kegg, chem_class, pathway))
                         #if no pipe in the metabolite name           
                         else:
                             # Handle the case where base_metabolite_name is None or does not contain '|'
-                            self.cursor.execute('''
-                                INSERT INTO Annotation (PeakID, MetaboliteName, KEGG, ChemicalClass, Pathway)
-                                VALUES (?, ?, ?, ?, ?);
-                            ''', (peak_id, metabolite, kegg, chem_class, pathway))
-                    
-                        #print(f'Inserted values: PeakID={peak_id}\tMetaboliteName={metabolite}\tKEGG={kegg}\tHMDB={hmdb}\tChemicalClass={chem_class}\tPathway={pathway}')
+                            annotation_rows.append((peak_id, metabolite, kegg, chem_class, pathway))
                     except Exception as inner_error:
                        print(f"Error processing a line in the annotation file: {inner_error}") 
+
+                    #Writing a full batch of rows
+                    if len(annotation_rows) >= self.batch_size:
+                        with self.timer('insert_annotation:write'):
+                            row_count += write_rows(annotation_rows)
+                        annotation_rows = []
+
+            #Writing the remaining rows
+            with self.timer('insert_annotation:write'):
+                row_count += write_rows(annotation_rows)
+            self.record_bytes_read(annotation_file, offset)
+            self.record_manifest(annotation_file, fingerprint)
             self.connection.commit()
+            self.report_load_rate('Annotation', row_count, start)
         except Exception as outer_error:
+            self.connection.rollback()
             print(f"An error occurred while loading annotation data: {outer_error}")
         
+    #Method for listing the feature names (peakIDs/protein names/transcript names) of an abundance table in storage order
+    def table_features(self, table_name):
+        cursor = self.connection.cursor()
+        if self.storage == 'long':
+            cursor.execute('SELECT FeatureName FROM Feature WHERE TableName = ? ORDER BY FeatureID', (table_name,))
+            return [row[0] for row in cursor.fetchall()]
+        cursor.execute(f'PRAGMA table_info({table_name})')
+        return [row[1] for row in cursor.fetchall()][2:]
+
+    #Method for listing the (SubjectID, VisitID) of all samples of an abundance table, ordered by subject and visit
+    def table_samples(self, table_name):
+        cursor = self.connection.cursor()
+        if self.storage == 'long':
+            cursor.execute('''
+                SELECT SubjectID, VisitID FROM Sample
+                WHERE TableName = ?
+                ORDER BY SubjectID, VisitID
+            ''', (table_name,))
+        else:
+            cursor.execute(f'SELECT SubjectID, VisitID FROM {table_name} ORDER BY SubjectID, VisitID')
+        return cursor.fetchall()
+
+    #Creating a method to stream the abundance values of a table as float rows, one row per sample
+    #Rows are in the order of table_samples and values in the order of table_features, with missing values as NaN
+    def iter_sample_values(self, table_name, features):
+        cursor = self.connection.cursor()
+        nan = float('nan')
+        if self.storage == 'long':
+            cursor.execute('SELECT FeatureID FROM Feature WHERE TableName = ? ORDER BY FeatureID', (table_name,))
+            positions = {row[0]: i for i, row in enumerate(cursor.fetchall())}
+            cursor.execute('''
+                SELECT SampleKey FROM Sample
+                WHERE TableName = ?
+                ORDER BY SubjectID, VisitID
+            ''', (table_name,))
+            for (sample_key,) in cursor.fetchall():
+                values = [nan] * len(features)
+                for feature_id, value in self.connection.execute(
+                        'SELECT FeatureID, Value FROM Abundance WHERE SampleKey = ?', (sample_key,)):
+                    if isinstance(value, (int, float)):
+                        values[positions[feature_id]] = value
+                yield values
+        else:
+            cursor.execute(f'SELECT {", ".join(features)} FROM {table_name} ORDER BY SubjectID, VisitID')
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    #Text such as 'NA' left in the REAL columns is treated as missing
+                    yield [value if isinstance(value, (int, float)) else nan for value in row]
+
+    #Method for the location of the sidecar files of a table, next to the database file
+    def sidecar_path(self, table_name, suffix):
+        return os.path.join(f'{self.db_2875662}.sidecar', f'{table_name}{suffix}')
+
+    #Method for the fingerprint of the data version, samples and features of a table, used to detect stale sidecars
+    def sidecar_fingerprint(self, version, samples, features):
+        digest = hashlib.sha1()
+        digest.update(f'{version}\n'.encode())
+        for subject_id, visit_id in samples:
+            digest.update(f'{subject_id}\t{visit_id}\n'.encode())
+        digest.update('\t'.join(features).encode())
+        return digest.hexdigest()
+
+    #Creating a method to write the columnar sidecar of an abundance table
+    #The matrix is stored as a column-major float32 .npy file, so the values of one feature are contiguous on disk
+    #and can be memory-mapped, with the sample and feature index files next to it
+    @profiled
+    def build_sidecar(self, table_name):
+        import numpy as np
+
+        version = self.table_version(table_name)
+        samples = self.table_samples(table_name)
+        features = self.table_features(table_name)
+        os.makedirs(f'{self.db_2875662}.sidecar', exist_ok=True)
+
+        #The metadata of the previous build is removed first and written last, so an interrupted build is detected as stale
+        try:
+            os.remove(self.sidecar_path(table_name, '.json'))
+        except FileNotFoundError:
+            pass
+
+        #Streaming the rows into the memory-mapped matrix chunk by chunk
+        matrix = np.lib.format.open_memmap(self.sidecar_path(table_name, '.npy'), mode='w+', dtype=np.float32,
+                                           shape=(len(samples), len(features)), fortran_order=True)
+        row = 0
+        for chunk in batched(self.iter_sample_values(table_name, features), self.batch_size):
+            matrix[row:row + len(chunk)] = np.asarray(chunk, dtype=np.float32)
+            row += len(chunk)
+        matrix.flush()
+        del matrix
+
+        with open(self.sidecar_path(table_name, '.samples.tsv'), 'w') as sample_file:
+            for subject_id, visit_id in samples:
+                sample_file.write(f'{subject_id}\t{visit_id}\n')
+        with open(self.sidecar_path(table_name, '.features.txt'), 'w') as feature_file:
+            for feature in features:
+                feature_file.write(f'{feature}\n')
+
+        with open(self.sidecar_path(table_name, '.json'), 'w') as meta_file:
+            json.dump({'table': table_name, 'version': version, 'samples': len(samples), 'features': len(features),
+                       'fingerprint': self.sidecar_fingerprint(version, samples, features)}, meta_file)
+
+    #Creating a method to open the sidecar of a table, rebuilding it first if it is missing or stale
+    #Returns the memory-mapped matrix, the list of (SubjectID, VisitID) and the list of features
+    def load_sidecar(self, table_name):
+        import numpy as np
+
+        version = self.table_version(table_name)
+        samples = self.table_samples(table_name)
+        features = self.table_features(table_name)
+        try:
+            with open(self.sidecar_path(table_name, '.json')) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get('fingerprint') != self.sidecar_fingerprint(version, samples, features):
+            self.build_sidecar(table_name)
+
+        matrix = np.load(self.sidecar_path(table_name, '.npy'), mmap_mode='r')
+        return matrix, samples, features
+
+    #Creating a method to compute a per-feature statistic over the sidecar, grouped by subject or visit
+    #stat is min, max or mean, or a percentile such as p50 or p90; group_by is subject, visit or None
+    #Only the columns of the requested features are read from the memory-mapped matrix
+    @profiled
+    def aggregate_features(self, table_name, features, stat, group_by=None):
+        import numpy as np
+
+        matrix, samples, table_features = self.load_sidecar(table_name)
+        positions = {name: i for i, name in enumerate(table_features)}
+
+        #Mapping every sample to its group
+        if group_by == 'subject':
+            keys = [subject_id for subject_id, _ in samples]
+        elif group_by == 'visit':
+            keys = [visit_id for _, visit_id in samples]
+        else:
+            keys = ['all'] * len(samples)
+        groups, inverse = np.unique(np.array(keys, dtype=object).astype(str), return_inverse=True)
+
+        results = []
+        for feature in features:
+            #Features can be given by their original name or by their column name
+            position = positions.get(feature, positions.get(new_column_name(feature)))
+            if position is None:
+                raise ValueError(f'Unknown feature {feature} in {table_name}')
+            column = np.asarray(matrix[:, position], dtype=np.float64)
+            present = ~np.isnan(column)
+            counts = np.bincount(inverse[present], minlength=len(groups))
+
+            if stat in ('min', 'max'):
+                values = np.full(len(groups), np.inf if stat == 'min' else -np.inf)
+                (np.minimum if stat == 'min' else np.maximum).at(values, inverse[present], column[present])
+            elif stat == 'mean':
+                values = np.bincount(inverse[present], weights=column[present], minlength=len(groups)) / np.maximum(counts, 1)
+            elif stat.startswith('p'):
+                #Sorting by group once and taking the percentile of every group slice
+                percentile = float(stat[1:])
+                order = np.lexsort((column, inverse))
+                bounds = np.searchsorted(inverse[order], np.arange(len(groups) + 1))
+                sorted_values = column[order]
+                values = np.array([np.nanpercentile(sorted_values[bounds[g]:bounds[g + 1]], percentile)
+                                   if counts[g] else np.nan for g in range(len(groups))])
+            else:
+                raise ValueError(f'Unknown statistic: {stat}')
+
+            #Groups without any measurement have no value
+            values = np.where(counts > 0, values, np.nan)
+            for group, value in zip(groups, values):
+                results.append((feature, group, None if np.isnan(value) else float(value)))
+        return results
+
+    #Method for the Subject covariates of a list of (SubjectID, VisitID) samples as a float matrix, with missing values as NaN
+    def covariate_matrix(self, samples):
+        import numpy as np
+
+        cursor = self.connection.cursor()
+        cursor.execute(f'SELECT SubjectID, {", ".join(COVARIATES)} FROM Subject')
+        covariates = {row[0]: [value if isinstance(value, (int, float)) else np.nan for value in row[1:]]
+                      for row in cursor.fetchall()}
+        missing = [np.nan] * len(COVARIATES)
+        return np.array([covariates.get(subject_id, missing) for subject_id, _ in samples], dtype=np.float64).reshape(-1, len(COVARIATES))
+
+    #Creating a method to compute the Pearson or Spearman correlation of features within or between abundance tables,
+    #or with the Subject covariates (source or target 'covariates'), with samples aligned on (SubjectID, VisitID)
+    #The features are correlated block by block from the memory-mapped sidecars in a pool of jobs worker processes,
+    #so neither matrix nor the correlation matrix is held in memory
+    #Yields (feature, feature, correlation, samples) for the top_k strongest pairs, ordered by strength,
+    #or, if only a threshold is given, for every pair whose absolute correlation reaches it, as they are found
+    #Missing values are left out pair by pair; for Spearman, the features of a pair are ranked over the samples where both are
+    #measured
+    def correlate_features(self, source, target=None, method='pearson', top_k=None, threshold=None, min_samples=3,
+                           block_size=CORRELATION_BLOCK_SIZE, jobs=1):
+        import numpy as np
+
+        target = target or source
+        for name in (source, target):
+            if name not in ABUNDANCE_TABLES and name != 'covariates':
+                raise ValueError(f'Unknown table for correlation: {name}')
+        if method not in ('pearson', 'spearman'):
+            raise ValueError(f'Unknown correlation method: {method}')
+        if top_k is None and threshold is None:
+            top_k = DEFAULT_TOP_K
+
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.db_2875662))) as work_dir:
+            with self.timer('correlate_features:prepare'):
+                #Opening the sidecars and aligning their rows on the samples that both tables have
+                sidecars = {name: self.load_sidecar(name) for name in {source, target} if name != 'covariates'}
+                if not sidecars:
+                    cursor = self.connection.cursor()
+                    cursor.execute('SELECT SubjectID, NULL FROM Subject ORDER BY SubjectID')
+                    samples = cursor.fetchall()
+                else:
+                    samples = sorted(set.intersection(*(set(samples) for _, samples, _ in sidecars.values())))
+
+                sides = {}
+                for name in {source, target}:
+                    if name == 'covariates':
+                        path = os.path.join(work_dir, 'covariates.npy')
+                        np.save(path, np.asfortranarray(self.covariate_matrix(samples)))
+                        sides[name] = [path, None, COVARIATES]
+                    else:
+                        _, table_samples, features = sidecars[name]
+                        positions = {sample: i for i, sample in enumerate(table_samples)}
+                        sides[name] = [self.sidecar_path(name, '.npy'), np.array([positions[sample] for sample in samples]), features]
+
+                #Writing the ranks of the aligned samples to a temporary matrix, block by block
+                if method == 'spearman':
+                    for name, side in sides.items():
+                        matrix = np.load(side[0], mmap_mode='r')
+                        ranks_path = os.path.join(work_dir, f'{name}.ranks.npy')
+                        ranks = np.lib.format.open_memmap(ranks_path, mode='w+', dtype=np.float32,
+                                                          shape=(len(samples), matrix.shape[1]), fortran_order=True)
+                        for start in range(0, matrix.shape[1], block_size):
+                            ranks[:, start:start + block_size] = rank_columns(read_block(matrix, side[1], start, start + block_size))
+                        ranks.flush()
+                        del ranks
+                        side[:2] = [ranks_path, None]
+
+            source_path, source_rows, source_names = sides[source]
+            target_path, target_rows, target_names = sides[target]
+            tasks = [{'source_path': source_path, 'source_rows': source_rows, 'target_path': target_path,
+                      'target_rows': target_rows, 'start': start, 'target_start': start if source == target else 0,
+                      'same_matrix': source == target, 'block_size': block_size, 'top_k': top_k,
+                      'threshold': threshold, 'min_samples': min_samples, 'method': method}
+                     for start in range(0, len(source_names), block_size)]
+
+            #Correlating the source blocks in the worker processes
+            pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+            try:
+                results = pool.map(correlate_block, tasks) if pool else map(correlate_block, tasks)
+                if top_k is None:
+                    for pairs in results:
+                        for i, j, correlation, count in pairs:
+                            yield source_names[i], target_names[j], correlation, count
+                    return
+
+                #Keeping the top_k strongest pairs of all blocks
+                strongest = []
+                for pairs in results:
+                    strongest = heapq.nlargest(top_k, strongest + pairs, key=lambda pair: abs(pair[2]))
+                for i, j, correlation, count in strongest:
+                    yield source_names[i], target_names[j], correlation, count
+            finally:
+                if pool:
+                    pool.shutdown(cancel_futures=True)
+
     #Method for querying the database with a givin SQL statement               
-    def query_db(self, sql):
+    def query_db(self, sql, params=()):
         try:
-        #connect to database
-            connection= sqlite3.connect(self.db_2875662)
-            #creating a cursor for SQL commands
-            cur= connection.cursor()
+            #creating a cursor for SQL commands on the shared read connection
+            cur= self.get_read_connection().cursor()
             #Execute the provided query
-            cur.execute(sql)
+            cur.execute(sql, params)
             #Fetching all rows from the query result
             rows= cur.fetchall()
             return rows
         except Exception as query_error:
             print(f"An error occurred while querying the database: {query_error}")
+            return []
+
+    #Method returning the connection used for queries
+    #It is opened on first use and reused by every query, so compiled statements are kept in its statement cache
+    def get_read_connection(self):
+        if self.read_connection is None:
+            #A read-only DatabaseManager has a single connection, opened for queries
+            if self.read_only:
+                self.read_connection = self.connection
+            else:
+                self.read_connection = sqlite3.connect(self.db_2875662, cached_statements=STATEMENT_CACHE_SIZE)
+            if self.profiler:
+                self.profiler.attach(self.read_connection)
+        return self.read_connection
+
+    #Method for opening a read-only connection
+    #For a snapshot, immutable=1 tells SQLite the file never changes, so no locks are taken and the file can be shared by any number of readers;
+    #otherwise the database should be in WAL mode, so the readers see the last committed data while a reload is writing
+    #The database is memory-mapped so readers share the OS page cache
+    #The connection may be used by another thread than the one that opened it, as long as only one thread uses it at a time
+    def connect_read_only(self):
+        uri = f'file:{urllib.parse.quote(os.path.abspath(self.db_2875662))}?mode=ro{"&immutable=1" if self.immutable else ""}'
+        connection = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+        connection.execute(f'PRAGMA mmap_size = {self.mmap_mb * 1024 * 1024}')
+        connection.execute(f'PRAGMA cache_size = {-self.cache_mb * 1024}')
+        return connection
+
+    #Creating a method to write a read-optimized snapshot of the database
+    #VACUUM INTO writes a compacted copy without free pages, with the given page size, and ANALYZE refreshes its planner statistics
+    #The snapshot is written next to its final path and renamed into place, so readers never see a partial snapshot
+    @profiled
+    def create_snapshot(self, output, page_size=SNAPSHOT_PAGE_SIZE):
+        if not valid_page_size(page_size):
+            raise ValueError(f'Page size must be a power of two from 512 to 65536: {page_size}')
+        temporary = f'{output}.tmp'
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        try:
+            self.connection.commit()
+            original_page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+            self.connection.execute(f'PRAGMA page_size = {int(page_size)}')
+            try:
+                self.connection.execute('VACUUM INTO ?', (temporary,))
+            finally:
+                self.connection.execute(f'PRAGMA page_size = {original_page_size}')
+
+            snapshot = sqlite3.connect(temporary)
+            try:
+                #The page size of a source in WAL mode cannot be changed by VACUUM INTO, so the snapshot is vacuumed again
+                if snapshot.execute('PRAGMA page_size').fetchone()[0] != int(page_size):
+                    snapshot.execute('PRAGMA journal_mode = DELETE')
+                    snapshot.execute(f'PRAGMA page_size = {int(page_size)}')
+                    snapshot.execute('VACUUM')
+                snapshot.execute('ANALYZE')
+                snapshot.commit()
+            finally:
+                snapshot.close()
+            os.replace(temporary, output)
+        except (sqlite3.Error, OSError) as e:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            print(f"Error writing snapshot: {e}")
+            return
+        print(f"Snapshot written to {output} ({os.path.getsize(output)} bytes, {os.path.getsize(self.db_2875662)} before compaction)")
+
+    #Method for running a query and returning its column names and an iterator over its rows
+    #Rows are fetched with fetchmany in chunks, so a large result is never held in memory
+    def iter_query(self, sql, params=(), chunk_size=None):
+        cur = self.get_read_connection().cursor()
+        cur.execute(sql, params)
+        columns = [description[0] for description in cur.description]
+
+        def rows():
+            while True:
+                chunk = cur.fetchmany(chunk_size or self.batch_size)
+                if not chunk:
+                    return
+                yield from chunk
+
+        return columns, rows()
+
+    #Method for streaming a query result to stdout or to an output file in one of the RESULT_FORMATS
+    #Returns the number of rows written
+    def write_query(self, columns, rows, fmt='text', output=None):
+        writer, binary = RESULT_FORMATS[fmt]
+        if output is None:
+            return writer(columns, rows, sys.stdout.buffer if binary else sys.stdout)
+        with open(output, 'wb' if binary else 'w', newline='' if not binary else None) as out:
+            return writer(columns, rows, out)
+
+    #Method for running a batch of queries in one process and reporting the time taken by each one on stderr
+    #The results of each query are preceded by a header line when more than one query is run
+    #When several queries are written to an output file, the query number is added before the file extension
+    def run_queries(self, query_nums, fmt='text', output=None):
+        for query_num in query_nums:
+            query_output = output
+            if output and len(query_nums) > 1:
+                root, extension = os.path.splitext(output)
+                query_output = f"{root}.{query_num}{extension}"
+            elif len(query_nums) > 1 and fmt == 'text':
+                #Only text results are headed by their query number, so the other formats stay machine-readable on stdout
+                print(f"Query {query_num}:", flush=True)
+            start = time.perf_counter()
+            row_count = self.run_query_on_database(query_num, fmt, query_output)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"Query {query_num}: {row_count} rows in {elapsed:.2f} ms", file=sys.stderr)
 
-    #Method for printing the result of a database query
-    def query_printer(self, result):
-        for row in result:
-            print('\t'.join(map(str, row)))
-    
     def close_connection(self):
         try:
             self.connection.close()
+            if self.read_connection is not None:
+                self.read_connection.close()
         except sqlite3.Error as e:
             print(f"Error closing connection: {e}")
     
-    # Method for running a query on the database and printing the result
-    def run_query_on_database(self, query_num):
-    
-        # parameterized statements for queries 1-9
-        # Retrieving the SubjectID and Age of subjects whose age is greater than 70
-        if query_num == 1:
-            sql1 = '''
-            SELECT SubjectID, Age
-            FROM Subject
-            WHERE Age > 70;
-        '''
-            query1 = self.query_db(sql1)  # using the query_db method on the db object
-            self.query_printer(query1)  # using the printer method on the db object
-
-        # Retrieving all female SubjectID who have a healthy BMI (18.5 to 24.9) and sorting the results by bmi in descending order
-        if query_num == 2:
-            sql2 = '''
-                        SELECT SubjectID
-                        FROM Subject
-                        WHERE Sex = 'F' AND BMI BETWEEN 18.5 and 24.9
-                        ORDER BY BMI DESC
-            '''
-            query2 = self.query_db(sql2)
-            self.query_printer(query2)
-
-        # Retrieving the Visit IDs of Subject 'ZNQOVZV'
-        # using the union function to select all the visit_ids across all abundance tables
-        # using the distinct operator so only unique visit_ids are extracted among the three tables
-        if query_num == 3:
-
-            sql3 = '''
-            SELECT DISTINCT VisitID
-            FROM TranscriptSamples
-            WHERE SubjectID = 'ZNQOVZV'
-
-
-            UNION
-
-            SELECT DISTINCT VisitID
-            FROM MetaboliteSamples
-            WHERE SubjectID = 'ZNQOVZV'
-
-
-            UNION
-
-            SELECT DISTINCT VisitID
-            FROM ProteinSamples
-            WHERE SubjectID = 'ZNQOVZV'
-            '''
-            query3 = self.query_db(sql3)
-            self.query_printer(query3)
-
-        # Retrieving the distinct SubjectIDs who have metabolomics samples and are insulin-resistant
-
-        if query_num == 4:
-            sql4 = '''
-                SELECT DISTINCT MetaboliteSamples.SubjectID
-                FROM MetaboliteSamples,
-                    Subject
-                WHERE InsulinSensitivity = 'IR'
-                AND MetaboliteSamples.SubjectID = Subject.SubjectID
-                '''
-
-            query4 = self.query_db(sql4)
-            self.query_printer(query4)
-
-        # Retrieving the unique KEGG IDs that have been annotated for the following peaks:
-        # 'nHILIC_121.0505_3.5', 'nHILIC_130.0872_6.3', 'nHILIC_133.0506_2.3', 'nHILIC_133.0506_4.4 '
-
-        if query_num == 5:
-            sql5 = ''' SELECT DISTINCT KEGG
-                FROM Annotation
-                WHERE PeakID in ('nHILIC_121.0505_3.5', 'nHILIC_130.0872_6.3', 'nHILIC_133.0506_2.3', 'nHILIC_133.0506_4.4')
-                '''
-
-            query5 = self.query_db(sql5)
-            self.query_printer(query5)
-
-        # Retrieving the minimum, maximum and average age of Subjects
-        if query_num == 6:
-            sql6 = '''SELECT MIN(Age) AS min_age,
-                    MAX(Age) AS max_age,
-                    AVG(Age) AS avg_age
-                    FROM Subject'''
-
-            query6 = self.query_db(sql6)
-            self.query_printer(query6)
-
-        # retrieving each pathway and the number of times it has been annotated
-        # only displaying the pathways with counts greater than 10
-        # ordering the results by the count in descending order
-        if query_num == 7:
-            sql7 = '''
-                    SELECT Pathway, COUNT(*) AS count
-                    FROM Annotation
-                    WHERE Pathway IS NOT NULL
-                    GROUP BY Pathway
-                    HAVING count > 10
-                    ORDER BY count DESC
-                '''
-
-            query7 = self.query_db(sql7)
-            self.query_printer(query7)
+    # Method returning the SQL statement and bound parameters of a catalogue query for the storage layout of the database
+    # Parameters that are not given take their default; the values of the batch parameters are loaded into temp.QueryBatch
+    def render_query(self, name, params=None):
+        query = QUERY_CATALOGUE[name]
+        params = dict(params or {})
+        unknown = set(params) - set(query['params'])
+        if unknown:
+            raise ValueError(f"Unknown parameters for query {name}: {', '.join(sorted(unknown))}")
+
+        #Converting the parameters to their declared types
+        bound = {}
+        for param, (param_type, default) in query['params'].items():
+            value = params.get(param, default)
+            if param in query.get('batch', ()):
+                values = value if isinstance(value, (list, tuple)) else [value]
+                bound[param] = [param_type(item) for item in values]
+            else:
+                bound[param] = param_type(value)
+
+        #Checking the identifiers that are put into the SQL
+        if 'table' in bound and bound['table'] not in ABUNDANCE_TABLES:
+            raise ValueError(f"Unknown abundance table: {bound['table']}")
+        if 'feature' in bound:
+            if isinstance(bound['feature'], list):
+                bound['feature'] = self.feature_columns(bound['table'], bound['feature'])
+            else:
+                bound['feature'] = self.feature_column(bound['table'], bound['feature'])
+
+        #Choosing the set-based statement when several batch values are given
+        sql = query['sql']
+        batches = {param: bound[param] for param in query.get('batch', ())}
+        if any(len(values) > 1 for values in batches.values()) and 'batch_sql' in query:
+            sql = query['batch_sql']
+        if batches:
+            self.load_query_batch(batches)
+            for param, values in batches.items():
+                bound[param] = values[0] if values else None
+        layer = SAMPLE_INDEX_COLUMNS.get(bound.get('table'))
+        return sql.format(table=bound.get('table'), feature=bound.get('feature'), layer=layer), bound
+
+    # Method returning the stored name of a feature of an abundance table, which may be given by its original or its column name
+    def feature_column(self, table_name, feature):
+        return self.feature_columns(table_name, [feature])[0]
+
+    # Method returning the stored names of several features of an abundance table
+    # In long storage every name is looked up in the unique (TableName, FeatureName) index of Feature,
+    # in wide storage in the cached set of the table's columns
+    def feature_columns(self, table_name, features):
+        if self.storage == 'long':
+            cursor = self.connection.cursor()
 
-        # Retrieving the maximum abundance of the transcript 'A1BG' for subject 'ZOZOW1T' across all samples
+            def stored(name):
+                cursor.execute('SELECT 1 FROM Feature WHERE TableName = ? AND FeatureName = ?', (table_name, name))
+                return cursor.fetchone() is not None
+        else:
+            stored = self.wide_features(table_name).__contains__
+
+        columns = []
+        for feature in features:
+            if stored(feature):
+                columns.append(feature)
+            elif stored(new_column_name(feature)):
+                columns.append(new_column_name(feature))
+            else:
+                raise ValueError(f"Unknown feature {feature} in {table_name}")
+        return columns
+
+    # Method returning the set of feature columns of a wide abundance table
+    # The set is listed again only when the schema version changes, i.e. after columns were added by a load
+    def wide_features(self, table_name):
+        schema_version = self.connection.execute('PRAGMA schema_version').fetchone()[0]
+        cached = self.feature_cache.get(table_name)
+        if cached is None or cached[0] != schema_version:
+            cached = self.feature_cache[table_name] = (schema_version, frozenset(self.table_features(table_name)))
+        return cached[1]
+
+    # Method for loading the values of the batch parameters into the temp.QueryBatch table of the query connection
+    # batches maps every batch parameter to its list of values
+    def load_query_batch(self, batches):
+        connection = self.get_read_connection()
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS QueryBatch (Param TEXT, Value TEXT, PRIMARY KEY (Param, Value)) WITHOUT ROWID')
+        connection.execute('DELETE FROM temp.QueryBatch')
+        connection.executemany('INSERT OR IGNORE INTO temp.QueryBatch (Param, Value) VALUES (?, ?)',
+                               ((param, value) for param, values in batches.items() for value in values))
+
+    # Method for running a catalogue query by name, e.g. run_named_query('max_abundance', subject=['ZOZOW1T', 'ZNQOVZV'])
+    def run_named_query(self, name, **params):
+        sql, bound = self.render_query(name, params)
+        return self.query_db(sql, bound)
+
+    # Method returning the SQL statement and bound parameters of one of the queries 1-9
+    def query_sql(self, query_num):
+        return self.render_query(QUERY_NAMES[query_num])
 
-        if query_num == 8:
-            sql8 = '''SELECT MAX(A1BG) as max_abundance
-                FROM TranscriptSamples
-                WHERE SubjectID = 'ZOZOW1T'
-                    
-                '''
+    # Method for running a query on the database and printing the result
+    # The result is streamed to stdout or to the output file, and the number of rows is returned
+    @profiled
+    def run_query_on_database(self, query_num, fmt='text', output=None):
+        sql, params = self.query_sql(query_num)
+        try:
+            columns, rows = self.iter_query(sql, params)
+        except sqlite3.Error as query_error:
+            print(f"An error occurred while querying the database: {query_error}")
+            return 0
 
-            query8 = self.query_db(sql8)
-            self.query_printer(query8)
+        # The rows of query 9 are also collected for the plot while they are written, unless the plot is split into subsets
+        if query_num == 9 and not self.plot_options['group_by']:
+            import plotting
+            points = {}
+            rows = plotting.collect_points(rows, points, 1, 2)
+        row_count = self.write_query(columns, rows, fmt, output)
 
-        # retrieving the age and bmi of of the subjects
-        # omitting the null values
+        # Generating the scatter plot of age vs bmi for query 9
         if query_num == 9:
+            plot_output = self.plot_options['output'] or 'age_bmi_scatterplot.png'
+            if self.plot_options['group_by']:
+                self.plot_age_bmi(self.plot_options['group_by'], plot_output)
+            else:
+                self.draw_plot(points, plot_output, 'Age', 'BMI', 'Scatter Plot of Age vs BMI')
+
+        return row_count
+
+    # Method for drawing collected points with the plot options of this DatabaseManager
+    def draw_plot(self, points, output, xlabel, ylabel, title, group_label=None):
+        import plotting
+        return plotting.plot_points(points, output, xlabel, ylabel, title, group_label,
+                                    show=self.plot_options['show'], density_threshold=self.plot_options['density_threshold'])
+
+    # Method for plotting the first two columns of a query result, one panel per value of the third column if group_label is given
+    # The points are collected straight from the cursor
+    def plot_query(self, sql, params, output, xlabel, ylabel, title, group_label=None):
+        import plotting
+        points = {}
+        _, rows = self.iter_query(sql, params)
+        collections.deque(plotting.collect_points(rows, points, 0, 1, 2 if group_label else None), maxlen=0)
+        return self.draw_plot(points, output, xlabel, ylabel, title, group_label)
+
+    # Method for plotting the age vs bmi of the subjects, one panel per value of a Subject column such as Sex
+    @profiled
+    def plot_age_bmi(self, group_by, output):
+        if group_by not in SUBJECT_GROUPS:
+            raise ValueError(f"Unknown subject group: {group_by}")
+        sql = f'''
+            SELECT Age, BMI, {group_by}
+            FROM Subject
+            WHERE Age IS NOT NULL AND BMI IS NOT NULL
+        '''
+        return self.plot_query(sql, (), output, 'Age', 'BMI', 'Scatter Plot of Age vs BMI', group_by)
+
+    # Method for plotting the abundance of a feature in every sample against a Subject covariate,
+    # optionally one panel per value of a Subject column such as Sex
+    @profiled
+    def plot_feature(self, table_name, feature, covariate='Age', group_by=None, output=None):
+        if table_name not in ABUNDANCE_TABLES:
+            raise ValueError(f"Unknown abundance table: {table_name}")
+        if covariate not in COVARIATES:
+            raise ValueError(f"Unknown covariate: {covariate}")
+        if group_by is not None and group_by not in SUBJECT_GROUPS:
+            raise ValueError(f"Unknown subject group: {group_by}")
+        feature = self.feature_column(table_name, feature)
+        group_column = f'Subject.{group_by}' if group_by else 'NULL'
+
+        if self.storage == 'long':
+            sql = f'''
+                SELECT Subject.{covariate}, Abundance.Value, {group_column}
+                FROM Feature, Abundance, Sample, Subject
+                WHERE Feature.TableName = ? AND Feature.FeatureName = ?
+                AND Abundance.FeatureID = Feature.FeatureID
+                AND Sample.SampleKey = Abundance.SampleKey
+                AND Subject.SubjectID = Sample.SubjectID
+            '''
+            params = (table_name, feature)
+        else:
+            sql = f'''
+                SELECT Subject.{covariate}, {table_name}.{feature}, {group_column}
+                FROM {table_name}, Subject
+                WHERE Subject.SubjectID = {table_name}.SubjectID
+            '''
+            params = ()
+        output = output or f'{feature}_{covariate.lower()}_plot.png'
+        return self.plot_query(sql, params, output, covariate, feature, f'{feature} vs {covariate}', group_by)
 
-            sql9 = '''
-                SELECT SubjectID, Age, BMI
-                FROM Subject
-                WHERE Age IS NOT NULL AND BMI IS NOT NULL'''
-
-            query9 = self.query_db(sql9)
-            self.query_printer(query9)
-
-            # Create a DataFrame from the query result
-            df = pd.DataFrame(query9, columns=["SubjectID", "Age", "BMI"])
-
-            # Generate a scatter plot
-            plt.scatter(df['Age'], df['BMI'])
-            plt.xlabel('Age')
-            plt.ylabel('BMI')
-            plt.title('Scatter Plot of Age vs BMI')
-            plt.grid(True)
-
-            # Save the scatter plot as a PNG file
-            plt.savefig('age_bmi_scatterplot.png')
-            plt.show()
 
 # Define the main function for the Database Manager script.
 def main():
@@ -432,13 +2472,78 @@ def main():
     parser.add_argument("db_2875662", help="Path to the SQLite database file")
     parser.add_argument("--createdb", action="store_true", help="Create the database structure")
     parser.add_argument("--loaddb", action="store_true", help="Parse data files and insert relevant data into the database")
-    parser.add_argument("--querydb", type=int, choices=range(1, 10), help="Run one of the specified queries (1 to 9)")
+    parser.add_argument("--querydb", type=parse_query_list, help="Run one or more of the specified queries (1 to 9), e.g. 3, 1-9 or 3,5,8")
+    parser.add_argument("--bulk", action="store_true", help="Use fast load-time pragmas during --loaddb and report rows/sec per table")
+    parser.add_argument("--batch-size", type=positive_int, default=DEFAULT_BATCH_SIZE, help="Number of rows per insert batch during --loaddb")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes parsing the abundance files during --loaddb, or computing --correlate")
+    parser.add_argument("--sidecar", action="store_true", help="Also write the columnar sidecar of every abundance table during --loaddb")
+    parser.add_argument("--aggregate", nargs=2, metavar=("TABLE", "FEATURE"), help="Compute a statistic of a feature from the columnar sidecar")
+    parser.add_argument("--stat", default="max", help="Statistic for --aggregate: min, max, mean or a percentile such as p50 (default: max)")
+    parser.add_argument("--group-by", choices=["subject", "visit"], help="Group --aggregate by subject or visit")
+    parser.add_argument("--correlate", nargs="+", metavar="TABLE", help="Correlate the features of an abundance table (or 'covariates') with each other or with a second table")
+    parser.add_argument("--method", choices=["pearson", "spearman"], default="pearson", help="Correlation method for --correlate (default: pearson); with missing values, spearman ranks every pair of features again over the samples where both are measured, which is slower")
+    parser.add_argument("--top-k", type=int, help=f"Write the K strongest pairs of --correlate (default: {DEFAULT_TOP_K} unless --threshold is given)")
+    parser.add_argument("--threshold", type=float, help="Write the pairs of --correlate with an absolute correlation of at least this value")
+    parser.add_argument("--min-samples", type=int, default=3, help="Minimum number of samples measured for both features of a --correlate pair (default: 3)")
+    parser.add_argument("--block-size", type=int, default=CORRELATION_BLOCK_SIZE, help=f"Number of features per block of --correlate (default: {CORRELATION_BLOCK_SIZE})")
+    parser.add_argument("--plot", nargs=2, metavar=("TABLE", "FEATURE"), help="Plot the abundance of a feature against a Subject covariate")
+    parser.add_argument("--covariate", choices=COVARIATES, default="Age", help="Covariate for --plot (default: Age)")
+    parser.add_argument("--plot-group", choices=SUBJECT_GROUPS, help="Draw --plot and the query 9 plot as one panel per value of this Subject column")
+    parser.add_argument("--plot-output", help="File for --plot or the query 9 plot (default: <feature>_<covariate>_plot.png, age_bmi_scatterplot.png)")
+    parser.add_argument("--density-threshold", type=int, help="Number of points above which a subset is drawn as a hexbin density (default: 5000)")
+    parser.add_argument("--show", action="store_true", help="Show the plots in a window as well as saving them")
+    parser.add_argument("--snapshot", metavar="OUT", help="Write a compacted, analyzed copy of the database for read-only query serving")
+    parser.add_argument("--page-size", type=snapshot_page_size, default=SNAPSHOT_PAGE_SIZE, help=f"Page size of the --snapshot copy, a power of two from 512 to 65536 (default: {SNAPSHOT_PAGE_SIZE})")
+    parser.add_argument("--read-only", action="store_true", help="Open the database (a snapshot) read-only and immutable, without locking")
+    parser.add_argument("--mmap-size", type=int, default=READ_ONLY_MMAP_MB, help=f"Memory-mapped size in MiB of --read-only connections (default: {READ_ONLY_MMAP_MB})")
+    parser.add_argument("--cache-size", type=int, default=READ_ONLY_CACHE_MB, help=f"Page cache size in MiB of --read-only connections (default: {READ_ONLY_CACHE_MB})")
+    parser.add_argument("--serve", action="store_true", help="Serve the query catalogue over HTTP (or --socket) until interrupted")
+    parser.add_argument("--host", default="127.0.0.1", help="Address for --serve (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Port for --serve (default: 8000)")
+    parser.add_argument("--socket", help="Serve on this Unix socket instead of a TCP port")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 4, help="Number of threads and read-only connections of --serve (default: number of CPUs)")
+    parser.add_argument("--explain", action="store_true", help="Print the query plan of every catalogue query and flag full table scans")
+    parser.add_argument("--query", choices=sorted(QUERY_CATALOGUE), help="Run a named query of the catalogue with the parameters below")
+    parser.add_argument("--subject", action="append", help="Subject(s) for --query, comma-separated, repeatable or @FILE")
+    parser.add_argument("--peak", action="append", help="Peak(s) for --query, comma-separated, repeatable or @FILE")
+    parser.add_argument("--table", help="Abundance table for --query")
+    parser.add_argument("--feature", action="append", help="Transcript(s)/protein(s)/peak(s) for --query, comma-separated, repeatable or @FILE")
+    parser.add_argument("--age", type=float, help="Age threshold for --query")
+    parser.add_argument("--sex", help="Sex for --query")
+    parser.add_argument("--bmi-min", type=float, help="Lower BMI bound for --query")
+    parser.add_argument("--bmi-max", type=float, help="Upper BMI bound for --query")
+    parser.add_argument("--insulin", help="Insulin sensitivity class for --query")
+    parser.add_argument("--min-count", type=int, help="Minimum count for --query")
+    parser.add_argument("--same-visit", type=int, choices=[0, 1], help="For --query complete_subjects, require all layers at one visit")
+    parser.add_argument("--format", choices=sorted(RESULT_FORMATS), help="Format of query results (default: from the --output extension, else text)")
+    parser.add_argument("--output", help="Write query results to this file instead of stdout")
+    parser.add_argument("--profile", metavar="REPORT", help="Write per-stage timers, counters, SQLite statement statistics and peak memory as JSON")
+    parser.add_argument("--cprofile", metavar="FILE", help="Write a cProfile dump of the run (readable with pstats)")
+    parser.add_argument("--storage", choices=["wide", "long"], help="Storage layout of the abundance tables (default: detected, 'wide' for new databases)")
 
     # Parse the command line arguments.
     args = parser.parse_args()
 
+    # A read-only snapshot cannot be created or loaded.
+    if args.read_only and (args.createdb or args.loaddb):
+        parser.error("--read-only cannot be combined with --createdb or --loaddb")
+
+    # Choose the output format of query results.
+    output_format = result_format(args.format, args.output)
+
     # Create an instance of the DatabaseManager with the specified SQLite database file.
-    db_manager = DatabaseManager(args.db_2875662)
+    db_manager = DatabaseManager(args.db_2875662, args.storage, args.batch_size, args.read_only, args.mmap_size, args.cache_size)
+
+    # Set the options of the plots.
+    db_manager.plot_options.update(group_by=args.plot_group, output=args.plot_output, show=args.show,
+                                   density_threshold=args.density_threshold)
+
+    # Enable the instrumentation and the Python profiler if requested.
+    if args.profile:
+        db_manager.enable_profiling()
+    if args.cprofile:
+        python_profiler = cProfile.Profile()
+        python_profiler.enable()
 
     # Check if the --createdb flag is provided, and create the database structure if true.
     if args.createdb:
@@ -446,6 +2551,12 @@ def main():
 
     # Check if the --loaddb flag is provided, and load data into the database if true.
     if args.loaddb:
+        # Switch to the fast load-time settings if a bulk load is requested.
+        # The secondary indexes are dropped and rebuilt after the load.
+        if args.bulk:
+            db_manager.begin_bulk_load()
+            db_manager.drop_indexes()
+
         # Load data into the Subject table from "Subject.csv".
         db_manager.insert_subject("Subject.csv")
 
@@ -453,17 +2564,112 @@ def main():
         proteome_columns = db_manager.create_abundance('HMP_proteome_abundance.tsv', 'ProteinSamples')
         metabolome_columns = db_manager.create_abundance('HMP_metabolome_abundance.tsv', 'MetaboliteSamples')
         transcriptome_columns = db_manager.create_abundance('HMP_transcriptome_abundance.tsv', 'TranscriptSamples')
-        db_manager.insert_abundance('HMP_proteome_abundance.tsv', 'ProteinSamples', proteome_columns)
-        db_manager.insert_abundance('HMP_metabolome_abundance.tsv', 'MetaboliteSamples', metabolome_columns)
-        db_manager.insert_abundance('HMP_transcriptome_abundance.tsv', 'TranscriptSamples', transcriptome_columns)
+        abundance_files = [
+            ('HMP_proteome_abundance.tsv', 'ProteinSamples', proteome_columns),
+            ('HMP_metabolome_abundance.tsv', 'MetaboliteSamples', metabolome_columns),
+            ('HMP_transcriptome_abundance.tsv', 'TranscriptSamples', transcriptome_columns),
+        ]
+
+        # Parse the abundance files in a process pool if more than one job is requested.
+        if args.jobs > 1:
+            db_manager.insert_abundance_parallel(abundance_files, args.jobs)
+        else:
+            for file_path, table_name, column_names in abundance_files:
+                db_manager.insert_abundance(file_path, table_name, column_names)
 
         # Load annotation data into the database from "HMP_metabolome_annotation.csv".
         db_manager.insert_annotation("HMP_metabolome_annotation.csv")
 
-    # Check if the --querydb flag is provided, and run the specified query if true.
+        # Write the columnar sidecars of the abundance tables if requested.
+        if args.sidecar:
+            for _, table_name, _ in abundance_files:
+                db_manager.build_sidecar(table_name)
+
+        # Build the secondary indexes and refresh the planner statistics.
+        db_manager.create_indexes()
+
+        # Restore the safe settings after a bulk load.
+        if args.bulk:
+            db_manager.end_bulk_load()
+
+    # Check if the --snapshot flag is provided, and write the read-optimized snapshot if true.
+    if args.snapshot:
+        db_manager.create_snapshot(args.snapshot, args.page_size)
+
+    # Check if the --explain flag is provided, and print the query plans if true.
+    if args.explain:
+        db_manager.explain_queries()
+
+    # Check if the --aggregate flag is provided, and compute the statistic from the sidecar if true.
+    if args.aggregate:
+        table_name, feature = args.aggregate
+        try:
+            result = db_manager.aggregate_features(table_name, [feature], args.stat, args.group_by)
+            db_manager.write_query(['Feature', 'Group', args.stat], iter(result), output_format, args.output)
+        except (KeyError, ValueError, sqlite3.Error) as e:
+            print(f"Error computing aggregate: {e}")
+
+    # Check if the --correlate flag is provided, and write the strongest feature correlations if true.
+    if args.correlate:
+        if len(args.correlate) > 2:
+            parser.error("--correlate takes one or two tables")
+        try:
+            pairs = db_manager.correlate_features(*args.correlate, method=args.method, top_k=args.top_k, threshold=args.threshold,
+                                                  min_samples=args.min_samples, block_size=args.block_size, jobs=args.jobs)
+            db_manager.write_query(['FeatureA', 'FeatureB', args.method, 'Samples'], pairs, output_format, args.output)
+        except (KeyError, ValueError, OSError, sqlite3.Error) as e:
+            print(f"Error computing correlations: {e}")
+
+    # Check if the --plot flag is provided, and plot the feature against the covariate if true.
+    if args.plot:
+        table_name, feature = args.plot
+        try:
+            print(f"Plot written to {db_manager.plot_feature(table_name, feature, args.covariate, args.plot_group, args.plot_output)}")
+        except (ValueError, OSError, sqlite3.Error) as e:
+            print(f"Error plotting {feature}: {e}")
+
+    # Check if the --query flag is provided, and run the named query with the given parameters if true.
+    if args.query:
+        params = {param: getattr(args, param) for param in QUERY_CATALOGUE[args.query]['params']
+                  if getattr(args, param) is not None}
+        for param in QUERY_CATALOGUE[args.query].get('batch', ()):
+            if param in params:
+                params[param] = expand_values(params[param])
+        try:
+            start = time.perf_counter()
+            columns, rows = db_manager.iter_query(*db_manager.render_query(args.query, params))
+            row_count = db_manager.write_query(columns, rows, output_format, args.output)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"Query {args.query}: {row_count} rows in {elapsed:.2f} ms", file=sys.stderr)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            print(f"Error running query {args.query}: {e}")
+
+    # Check if the --querydb flag is provided, and run the specified queries if true.
     if args.querydb is not None:
-        db_manager.run_query_on_database(args.querydb)
+        db_manager.run_queries(args.querydb, output_format, args.output)
     
+    # Check if the --serve flag is provided, and serve the query catalogue until interrupted if true.
+    if args.serve:
+        import server
+
+        # A database that is not an immutable snapshot is switched to WAL mode, so a reload does not block the readers.
+        if not args.read_only:
+            db_manager.connection.execute('PRAGMA journal_mode = WAL')
+        db_managers = [DatabaseManager(args.db_2875662, db_manager.storage, args.batch_size, True, args.mmap_size, args.cache_size,
+                                       immutable=args.read_only) for _ in range(max(1, args.threads))]
+        try:
+            server.serve(db_managers, QUERY_CATALOGUE, QUERY_NAMES, RESULT_FORMATS, args.host, args.port, args.socket)
+        finally:
+            for pooled_manager in db_managers:
+                pooled_manager.close_connection()
+
+    # Write the profile reports.
+    if args.cprofile:
+        python_profiler.disable()
+        python_profiler.dump_stats(args.cprofile)
+    if args.profile:
+        db_manager.write_profile(args.profile)
+
     #Implementing the close_connection method
     db_manager.close_connection()
 
@@ -0,0 +1,270 @@
+#Benchmark harness for loading and querying the multi-omics database
+#Generates synthetic Subject.csv, abundance and annotation files of a chosen size, times every load stage
+#and every catalogue query, and writes the timings as JSON that can be compared between runs
+
+#Importing the relevant modules
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+#Loading the DatabaseManager script as a module (its file name is not a valid module name)
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '2875662_CW2.py')
+spec = importlib.util.spec_from_file_location('multiomics_db', SCRIPT)
+multiomics_db = importlib.util.module_from_spec(spec)
+#Registering the module so that the --jobs worker processes can unpickle its functions
+sys.modules['multiomics_db'] = multiomics_db
+spec.loader.exec_module(multiomics_db)
+
+#Subjects, transcript and peaks used by the default catalogue queries, included in every generated dataset
+QUERY_SUBJECTS = ['ZNQOVZV', 'ZOZOW1T']
+QUERY_TRANSCRIPTS = ['A1BG']
+QUERY_PEAKS = ['nHILIC_121.0505_3.5', 'nHILIC_130.0872_6.3', 'nHILIC_133.0506_2.3', 'nHILIC_133.0506_4.4']
+
+PATHWAYS = ['Glycolysis- Gluconeogenesis- and Pyruvate Metabolism', 'Pyrimidine Metabolism', 'Fatty Acid Metabolism',
+            'Glutathione Metabolism', 'Tryptophan Metabolism', 'Urea cycle', 'Food Component/Plant']
+CHEMICAL_CLASSES = ['Amino Acid', 'Lipid', 'Carbohydrate', 'Nucleotide', 'Xenobiotics']
+
+#Slowdowns smaller than this many seconds are timing noise and never reported as regressions
+MIN_REGRESSION_SECONDS = 0.001
+
+
+#Function to write a synthetic dataset with the same layout as the input files
+#sparsity is the fraction of abundance values written as NA
+def generate_dataset(out_dir, subjects, visits, features, sparsity=0.0, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    #Subject IDs in the style of the study, starting with the subjects used by the queries
+    subject_ids = QUERY_SUBJECTS[:subjects]
+    while len(subject_ids) < subjects:
+        subject_id = 'Z' + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(6))
+        if subject_id not in subject_ids:
+            subject_ids.append(subject_id)
+
+    with open(os.path.join(out_dir, 'Subject.csv'), 'w') as subject_file:
+        subject_file.write('SubjectID,Race,Sex,Age,BMI,SSPG,IR_IS_classification\n')
+        for subject_id in subject_ids:
+            sspg = rng.randint(40, 300)
+            row = [subject_id, rng.choice('ABC'), rng.choice('MF'), f'{rng.uniform(25, 80):.2f}',
+                   f'{rng.uniform(17, 40):.2f}', str(sspg), 'IR' if sspg > 150 else 'IS']
+            #A few subjects have missing measurements, as in the study
+            if rng.random() < 0.05:
+                row[3:7] = ['NA', 'NA', 'NA', 'Unknown']
+            subject_file.write(','.join(row) + '\n')
+
+    #Sample IDs are SubjectID-VisitID
+    sample_ids = [f'{subject_id}-{visit:02d}' for subject_id in subject_ids for visit in range(1, visits + 1)]
+
+    transcripts = QUERY_TRANSCRIPTS + [f'TX{i}' for i in range(features - len(QUERY_TRANSCRIPTS))]
+    proteins = [f'PROT{i}' for i in range(features)]
+    peaks = QUERY_PEAKS + [f'nHILIC_{100 + i * 0.01:.4f}_{rng.uniform(1, 10):.1f}' for i in range(features - len(QUERY_PEAKS))]
+
+    for file_name, names in (('HMP_transcriptome_abundance.tsv', transcripts),
+                             ('HMP_proteome_abundance.tsv', proteins),
+                             ('HMP_metabolome_abundance.tsv', peaks)):
+        with open(os.path.join(out_dir, file_name), 'w') as abundance_file:
+            abundance_file.write('\t'.join(['SampleID'] + names) + '\n')
+            for sample_id in sample_ids:
+                values = ['NA' if rng.random() < sparsity else f'{rng.gauss(5, 2):.5f}' for _ in names]
+                abundance_file.write('\t'.join([sample_id] + values) + '\n')
+
+    #Every peak is annotated, some with several metabolites separated by a pipe
+    with open(os.path.join(out_dir, 'HMP_metabolome_annotation.csv'), 'w') as annotation_file:
+        annotation_file.write('PeakID,Metabolite,KEGG,HMDB,Chemical Class,Pathway\n')
+        for i, peak in enumerate(peaks):
+            metabolites = [f'Metabolite{i}_{j}' for j in range(rng.choice((1, 1, 1, 2)))]
+            keggs = [f'C{rng.randint(0, 99999):05d}' for _ in metabolites]
+            annotation_file.write(','.join([peak, '|'.join(metabolites), '|'.join(keggs), '',
+                                            rng.choice(CHEMICAL_CLASSES), rng.choice(PATHWAYS)]) + '\n')
+
+    return out_dir
+
+
+#Function to time the load stages of a dataset into a new database
+#Returns a dictionary of stage name to seconds
+def benchmark_load(data_dir, db_path, storage, jobs, bulk):
+    stages = {}
+    db_manager = multiomics_db.DatabaseManager(db_path, storage)
+    files = [(os.path.join(data_dir, 'HMP_proteome_abundance.tsv'), 'ProteinSamples'),
+             (os.path.join(data_dir, 'HMP_metabolome_abundance.tsv'), 'MetaboliteSamples'),
+             (os.path.join(data_dir, 'HMP_transcriptome_abundance.tsv'), 'TranscriptSamples')]
+
+    #Helper function to time one stage
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        stages[stage] = time.perf_counter() - start
+        return result
+
+    try:
+        timed('create_subject_annot', db_manager.create_subject_annot)
+        if bulk:
+            db_manager.begin_bulk_load()
+        timed('insert_subject', db_manager.insert_subject, os.path.join(data_dir, 'Subject.csv'))
+
+        abundance_files = []
+        for file_path, table_name in files:
+            column_names = timed(f'create_abundance:{table_name}', db_manager.create_abundance, file_path, table_name)
+            abundance_files.append((file_path, table_name, column_names))
+
+        if jobs > 1:
+            timed('insert_abundance_parallel', db_manager.insert_abundance_parallel, abundance_files, jobs)
+        else:
+            for file_path, table_name, column_names in abundance_files:
+                timed(f'insert_abundance:{table_name}', db_manager.insert_abundance, file_path, table_name, column_names)
+
+        timed('insert_annotation', db_manager.insert_annotation, os.path.join(data_dir, 'HMP_metabolome_annotation.csv'))
+        timed('create_indexes', db_manager.create_indexes)
+        if bulk:
+            db_manager.end_bulk_load()
+    finally:
+        db_manager.close_connection()
+    stages['total'] = sum(stages.values())
+    return stages
+
+
+#Function to time the load of a dataset repeats times, each into a new database
+#Returns a dictionary of stage name to the median, minimum and maximum seconds over the repeats
+def benchmark_loads(data_dir, db_path, storage, jobs, bulk, repeats):
+    samples = {}
+    for _ in range(repeats):
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        for stage, seconds in benchmark_load(data_dir, db_path, storage, jobs, bulk).items():
+            samples.setdefault(stage, []).append(seconds)
+    return {stage: {'median': statistics.median(times), 'min': min(times), 'max': max(times)}
+            for stage, times in samples.items()}
+
+
+#Function to time every catalogue query on a loaded database
+#Returns a dictionary of query name to the median, minimum and maximum seconds over the repeats
+def benchmark_queries(db_path, repeats):
+    timings = {}
+    db_manager = multiomics_db.DatabaseManager(db_path)
+    try:
+        for name in multiomics_db.QUERY_CATALOGUE:
+            samples = []
+            rows = 0
+            for _ in range(repeats):
+                start = time.perf_counter()
+                columns, result = db_manager.iter_query(*db_manager.render_query(name))
+                rows = sum(1 for _ in result)
+                samples.append(time.perf_counter() - start)
+            timings[name] = {'median': statistics.median(samples), 'min': min(samples), 'max': max(samples), 'rows': rows}
+    finally:
+        db_manager.close_connection()
+    return timings
+
+
+#Function to parse a size such as 100x4x2000 into (subjects, visits, features)
+def parse_size(value):
+    try:
+        subjects, visits, features = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"size must be SUBJECTSxVISITSxFEATURES: {value}")
+    return subjects, visits, features
+
+
+#Function to tell whether a timing is slower than its baseline timing
+#Both are dictionaries with the median, minimum and maximum seconds of their repeats; the medians are compared, and
+#every current sample must also be slower than every baseline sample, so that timing noise is not reported
+def is_regression(old, new, threshold):
+    return (new['median'] > old['median'] * (1 + threshold) and new['median'] - old['median'] > MIN_REGRESSION_SECONDS
+            and new.get('min', new['median']) > old.get('max', old['median']))
+
+
+#Function to compare the timings of a run with a baseline run
+#Returns the list of (size, storage, stage or query, baseline seconds, current seconds) that are slower than the threshold
+def find_regressions(baseline, current, threshold):
+    baseline_runs = {(run['size'], run['storage']): run for run in baseline['runs']}
+    regressions = []
+    for run in current['runs']:
+        previous = baseline_runs.get((run['size'], run['storage']))
+        if not previous or 'error' in run or 'error' in previous:
+            continue
+        for stage, timing in run['load'].items():
+            old = previous['load'].get(stage)
+            #Baselines written before the load stages were repeated hold a single number of seconds per stage
+            if isinstance(old, (int, float)):
+                old = {'median': old}
+            if old and is_regression(old, timing, threshold):
+                regressions.append((run['size'], run['storage'], stage, old['median'], timing['median']))
+        for name, timing in run['queries'].items():
+            old = previous['queries'].get(name)
+            if old and is_regression(old, timing, threshold):
+                regressions.append((run['size'], run['storage'], f'query:{name}', old['median'], timing['median']))
+    return regressions
+
+
+# Define the main function for the benchmark script.
+def main():
+    parser = argparse.ArgumentParser(description="Load and query benchmark with synthetic multi-omics data")
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=[parse_size('20x4x200'), parse_size('100x8x1000')],
+                        help="Dataset sizes as SUBJECTSxVISITSxFEATURES (features per omics file)")
+    parser.add_argument("--storage", nargs="+", choices=["wide", "long"], default=["wide", "long"], help="Storage layouts to benchmark")
+    parser.add_argument("--sparsity", type=float, default=0.0, help="Fraction of abundance values that are missing")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of parser processes for the abundance files")
+    parser.add_argument("--bulk", action="store_true", help="Use the bulk load pragmas")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of times each query is run")
+    parser.add_argument("--load-repeats", type=int, default=3, help="Number of times each dataset is loaded (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data generator")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file for the results")
+    parser.add_argument("--compare", help="Baseline JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown reported as a regression (default: 0.2)")
+    parser.add_argument("--workdir", help="Directory for the generated data and databases (default: a temporary directory)")
+    args = parser.parse_args()
+
+    results = {
+        'meta': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+                 'sparsity': args.sparsity, 'jobs': args.jobs, 'bulk': args.bulk, 'repeats': args.repeats,
+                 'load_repeats': args.load_repeats, 'seed': args.seed},
+        'runs': [],
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = args.workdir or temp_dir
+        for subjects, visits, features in args.sizes:
+            size = f'{subjects}x{visits}x{features}'
+            data_dir = generate_dataset(os.path.join(workdir, size), subjects, visits, features, args.sparsity, args.seed)
+            for storage in args.storage:
+                db_path = os.path.join(workdir, f'{size}_{storage}.db')
+                run = {'size': size, 'subjects': subjects, 'visits': visits, 'features': features, 'storage': storage}
+                try:
+                    run['load'] = benchmark_loads(data_dir, db_path, storage, args.jobs, args.bulk, args.load_repeats)
+                    run['queries'] = benchmark_queries(db_path, args.repeats)
+                    print(f"{size} {storage}: load {run['load']['total']['median']:.2f}s, "
+                          f"queries {sum(timing['median'] for timing in run['queries'].values()) * 1000:.1f} ms")
+                #create_abundance exits when a wide table has more columns than SQLite allows
+                except SystemExit:
+                    run['error'] = 'create_abundance failed'
+                    print(f"{size} {storage}: failed ({run['error']})")
+                except sqlite3.Error as e:
+                    run['error'] = str(e)
+                    print(f"{size} {storage}: failed ({run['error']})")
+                results['runs'].append(run)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    #Reporting the stages and queries that became slower than the baseline
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = find_regressions(json.load(baseline_file), results, args.threshold)
+        for size, storage, stage, old, new in regressions:
+            print(f"REGRESSION {size} {storage} {stage}: {old * 1000:.2f} ms -> {new * 1000:.2f} ms")
+        if regressions:
+            sys.exit(1)
+
+
+# Entry point: Execute the main function if the script is run as the main module.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#Plotting of query results for the multi-omics database
+#Imported only when a plot is drawn, so runs that do not plot do not pay for importing matplotlib
+#Plots are written to a file with the non-interactive Agg backend unless they are shown in a window
+
+#Importing the relevant modules
+from array import array
+
+#Number of points of a subset above which it is drawn as a hexbin density plot instead of a scatter plot
+DENSITY_THRESHOLD = 5000
+
+#Number of hexagons across the x axis of a density plot
+HEXBIN_GRIDSIZE = 60
+
+
+#Function to collect the points of a plot from a stream of query result rows
+#Rows are passed through unchanged, so the same stream can be written out while it is plotted
+#points maps every subset (the value of the group column, or None without one) to its x and y values
+def collect_points(rows, points, x_index, y_index, group_index=None):
+    for row in rows:
+        x, y = row[x_index], row[y_index]
+        if isinstance(x, (int, float)) and isinstance(y, (int, float)):
+            group = row[group_index] if group_index is not None else None
+            if group not in points:
+                points[group] = (array('d'), array('d'))
+            points[group][0].append(x)
+            points[group][1].append(y)
+        yield row
+
+
+#Function to draw the collected points, one panel per subset, and save the figure
+#Subsets with more than density_threshold points are drawn as hexbin densities
+#group_label names the group column in the panel titles
+def plot_points(points, output, xlabel, ylabel, title, group_label=None, show=False, density_threshold=None):
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    if density_threshold is None:
+        density_threshold = DENSITY_THRESHOLD
+
+    #Subsets in a stable order, with missing group values last
+    groups = sorted(points, key=lambda group: (group is None, str(group)))
+    figure, axes = plt.subplots(1, max(1, len(groups)), figsize=(6 * max(1, len(groups)), 5),
+                                sharex=True, sharey=True, squeeze=False)
+
+    for axis, group in zip(axes[0], groups):
+        x, y = points[group]
+        if len(x) > density_threshold:
+            density = axis.hexbin(x, y, gridsize=HEXBIN_GRIDSIZE, mincnt=1, bins='log', cmap='viridis')
+            figure.colorbar(density, ax=axis, label='count')
+        else:
+            axis.scatter(x, y)
+        axis.set_xlabel(xlabel)
+        axis.set_ylabel(ylabel)
+        if group_label is not None:
+            axis.set_title(f'{group_label} = {group} (n = {len(x)})')
+        axis.grid(True)
+
+    if not groups:
+        axes[0][0].set_xlabel(xlabel)
+        axes[0][0].set_ylabel(ylabel)
+    figure.suptitle(title)
+
+    #Saving the plot as a PNG file, and showing it only if asked to
+    figure.savefig(output)
+    if show:
+        plt.show()
+    plt.close(figure)
+    return output
@@ -0,0 +1,241 @@
+#Query server for the multi-omics database
+#Serves the query catalogue over HTTP on localhost or a Unix socket from a long-running process,
+#so every request runs on a warm DatabaseManager with compiled statements and a filled page cache
+#Imported only by --serve
+
+#Importing the relevant modules
+import collections
+import http.server
+import io
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+#Number of recent latencies per query kept for the percentiles of /metrics
+LATENCY_WINDOW = 1000
+
+#Format of query results when the request does not give one, and the content type of every format
+DEFAULT_FORMAT = 'jsonl'
+CONTENT_TYPES = {
+    'text': 'text/plain; charset=utf-8',
+    'tsv': 'text/tab-separated-values; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+#Class collecting the latency of every served query
+class QueryMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.queries = {}
+        self.in_flight = 0
+
+    #Method for counting a request that has started
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    #Method for recording a finished request of a query, with its latency in milliseconds and the number of rows returned
+    def record(self, name, elapsed_ms, rows, error=False):
+        with self.lock:
+            self.in_flight -= 1
+            entry = self.queries.get(name)
+            if entry is None:
+                entry = self.queries[name] = {'count': 0, 'errors': 0, 'rows': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                              'recent_ms': collections.deque(maxlen=LATENCY_WINDOW)}
+            entry['count'] += 1
+            entry['errors'] += int(error)
+            entry['rows'] += rows
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry['recent_ms'].append(elapsed_ms)
+
+    #Method returning the metrics as a dictionary, with the mean and the percentiles of the recent latencies
+    def report(self):
+        with self.lock:
+            queries = {}
+            for name, entry in sorted(self.queries.items()):
+                recent = sorted(entry['recent_ms'])
+                queries[name] = {
+                    'count': entry['count'],
+                    'errors': entry['errors'],
+                    'rows': entry['rows'],
+                    'avg_ms': entry['total_ms'] / entry['count'],
+                    'max_ms': entry['max_ms'],
+                    'p50_ms': recent[len(recent) // 2],
+                    'p95_ms': recent[min(len(recent) - 1, len(recent) * 95 // 100)],
+                    'p99_ms': recent[min(len(recent) - 1, len(recent) * 99 // 100)],
+                }
+            return {'uptime_seconds': time.time() - self.start, 'in_flight': self.in_flight, 'queries': queries}
+
+
+#Mixin handing every accepted request to a thread pool instead of handling it in the accepting thread
+class PooledServerMixin:
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+#HTTP server on a TCP port
+class PooledHTTPServer(PooledServerMixin, http.server.HTTPServer):
+    pass
+
+
+#HTTP server on a Unix socket
+class PooledUnixHTTPServer(PooledServerMixin, socketserver.UnixStreamServer):
+    pass
+
+
+#Class handling the requests of the query server
+#GET /queries lists the catalogue, GET /query/NAME (or the query number) runs a query with its parameters
+#from the query string, and GET /metrics returns the latency metrics
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['queries']:
+            self.send_json(200, self.server.catalogue)
+        elif parts == ['metrics']:
+            self.send_json(200, dict(self.server.metrics.report(), connections=self.server.pool_size))
+        elif len(parts) == 2 and parts[0] == 'query':
+            self.run_query(parts[1], urllib.parse.parse_qs(url.query))
+        else:
+            self.send_json(404, {'error': f'Unknown path: {url.path}'})
+
+    #Method for running a catalogue query on a pooled DatabaseManager and streaming the result
+    def run_query(self, name, query_string):
+        name = self.server.query_names.get(int(name), name) if name.isdigit() else name
+        query = self.server.query_catalogue.get(name)
+        if query is None:
+            self.send_json(404, {'error': f'Unknown query: {name}'})
+            return
+        fmt = query_string.pop('format', [DEFAULT_FORMAT])[-1]
+        if fmt not in self.server.result_formats:
+            self.send_json(400, {'error': f'Unknown format: {fmt}'})
+            return
+
+        #Parameters given more than once or as comma-separated lists are batch values
+        params = {}
+        for param, values in query_string.items():
+            if param in query.get('batch', ()):
+                params[param] = [item for value in values for item in value.split(',') if item]
+            else:
+                params[param] = values[-1]
+
+        self.server.metrics.begin()
+        start = time.perf_counter()
+        row_count = 0
+        error = True
+        db_manager = self.server.pool.get()
+        try:
+            try:
+                sql, bound = db_manager.render_query(name, params)
+                columns, rows = db_manager.iter_query(sql, bound)
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPES[fmt])
+            self.end_headers()
+            writer, binary = self.server.result_formats[fmt]
+            if binary:
+                row_count = writer(columns, rows, self.wfile)
+            else:
+                out = io.TextIOWrapper(self.wfile, encoding='utf-8', newline='', write_through=True)
+                try:
+                    row_count = writer(columns, rows, out)
+                finally:
+                    out.detach()
+            error = False
+        finally:
+            self.server.pool.put(db_manager)
+            self.server.metrics.record(name, (time.perf_counter() - start) * 1000, row_count, error)
+
+    #Method for sending a JSON response
+    def send_json(self, status, body):
+        data = json.dumps(body, indent=2).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    #Requests are counted in the metrics instead of being logged one by one
+    def log_message(self, format, *args):
+        pass
+
+    #Clients of a Unix socket have no address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+#Function to describe the query catalogue as JSON: the number, parameters with their type and default, and batch parameters of every query
+def describe_catalogue(query_catalogue):
+    return {
+        name: {
+            'number': query.get('number'),
+            'params': {param: {'type': param_type.__name__, 'default': default}
+                       for param, (param_type, default) in query['params'].items()},
+            'batch': list(query.get('batch', ())),
+        }
+        for name, query in query_catalogue.items()
+    }
+
+
+#Function to serve the query catalogue until interrupted
+#db_managers are read-only DatabaseManagers, one per worker thread, which are handed out to the requests through a queue
+def serve(db_managers, query_catalogue, query_names, result_formats, host='127.0.0.1', port=8000, socket_path=None):
+    pool = queue.Queue()
+    for db_manager in db_managers:
+        pool.put(db_manager)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = PooledUnixHTTPServer(socket_path, QueryHandler)
+        address = f'unix:{socket_path}'
+    else:
+        server = PooledHTTPServer((host, port), QueryHandler)
+        address = f'http://{host}:{server.server_address[1]}'
+
+    server.executor = ThreadPoolExecutor(max_workers=len(db_managers))
+    server.pool = pool
+    server.pool_size = len(db_managers)
+    server.metrics = QueryMetrics()
+    server.query_catalogue = query_catalogue
+    server.query_names = query_names
+    server.result_formats = result_formats
+    server.catalogue = describe_catalogue(query_catalogue)
+
+    print(f"Serving {len(query_catalogue)} queries on {address} with {len(db_managers)} threads", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.executor.shutdown(wait=True)
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)